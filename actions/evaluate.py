@@ -4,8 +4,10 @@ from torch import nn
 import random
 import time
 import numpy as np
+from data.prefetch import Prefetcher
 from model import DEVICE, SOS_token, EOS_token
 from model.beam_search2 import BeamSearchDecoder, Beam
+from model.utils import ChunkedDataParallel
 
 # config: max_length, span_size, hidden_size
 
@@ -16,8 +18,9 @@ class Evaluator(object):
         self.encoder = models['encoder']
         self.decoder = models['decoder']
         if 'cuda' in DEVICE.type:
-            self.encoder = nn.DataParallel(self.encoder)
-            self.decoder = nn.DataParallel(self.decoder)
+            # Keep the input lengths on the CPU, where pack_padded_sequence needs them
+            self.encoder = ChunkedDataParallel(self.encoder, host_args=(1,))
+            self.decoder = ChunkedDataParallel(self.decoder, host_kwargs=('input_lens',))
         self.encoder.eval()
         self.decoder.eval()
         self.dataloader = dataloader
@@ -48,24 +51,21 @@ class Evaluator(object):
 
             span_seq_len = int(self.config['max_length'] / self.config['span_size'])
 
-            decoder_hidden = torch.zeros(self.config['num_layers'] + 1 + self.config['more_decoder_layers'],
-                                         batch_inputs.size()[0], self.config['hidden_size'], device=DEVICE)
-            decoder_cell = torch.zeros(self.config['num_layers'] + 1 + self.config['more_decoder_layers'],
-                                       batch_inputs.size()[0], self.config['hidden_size'], device=DEVICE)
+            decoder_hidden, decoder_cell = getattr(self.decoder, 'module', self.decoder).zero_state(batch_size)
             decoder_input = torch.tensor([SOS_token] * self.config['span_size'] * batch_size, device=DEVICE).view(
                 batch_size, -1)
             decoder_outputs = torch.zeros((batch_size, self.config['max_length']), dtype=torch.long, device=DEVICE)
 
+            # Project the attention keys and values once rather than at every step
+            attention_state = getattr(self.decoder, 'module', self.decoder).init_state(encoder_outputs, batch_input_lens)
             for i in range(0, span_seq_len * self.config['span_size'], self.config['span_size']):
                 decoder_output, decoder_hidden, decoder_cell, decoder_attn = self.decoder(decoder_input,
-                                                                            decoder_hidden, decoder_cell, encoder_outputs)
+                                                                            decoder_hidden, decoder_cell, attention_state)
                 topv, topi = decoder_output.topk(1, dim=2)
                 decoder_input = topi.squeeze(2)
                 decoder_outputs[:, i:i + self.config['span_size']] = topi.squeeze(2)
 
-            decoded_words = [[self.dataloader.dataset.index2word[w.item()] for w in tensor_sentence]
-                                 for tensor_sentence in decoder_outputs]
-            return decoded_words
+            return self.dataset.vocab.decode(decoder_outputs)
 
     def generate_batch_beam(self, batch_inputs, batch_input_lens):
         with torch.no_grad():
@@ -81,56 +81,59 @@ class Evaluator(object):
             return self.beam_search_decoder.decode_batch(encoder_outputs, encoder_hidden,
                                                          torch.tensor([[self.sos_idx] * self.config['span_size'] *
                                                                        batch_size], dtype=torch.long)
-                                                         .view(batch_size, -1))
+                                                         .view(batch_size, -1),
+                                                         batch_input_lens)
 
-    def evaluate_beam(self):
-        batches = self.dataloader
-        start = time.time()
-        ordered_outputs = []
-        for batch in batches:
+    def generate_beam(self):
+        ''' Generate the (example id, prediction) of each example using beam search '''
+        for batch in self.dataloader:
             beams = self.generate_batch_beam(batch['inputs'], batch['input_lens'])
             for i, example_id in enumerate(batch['example_ids']):
-                outputs = []
-                beam = beams[i]
-                sequence = beam.best_hypothesis.sequence[self.config['span_size']:]
-                decoded = [self.dataloader.dataset.index2word[w.item()] for w in sequence]
-                outputs.append(decoded)
-                ordered_outputs.append((example_id, outputs))
-        print("Evaluation time for {} sentences is {} for checkpoint {}".format(len(self.dataloader.dataset.pairs),
-                                                                                time.time() - start,
-                                                                                self.config['restore']))
-        preds = []
-        for _, outputs in sorted(ordered_outputs, key=lambda x: x[0]):  # pylint:disable=consider-using-enumerate
-            preds.extend(outputs)
-        return preds
+                sequence = beams[i].best_hypothesis.sequence[self.config['span_size']:]
+                yield example_id, self.dataset.vocab.decode(sequence)
 
-    def evaluate_greedy(self):
-        batches = self.dataloader
-        start = time.time()
-        preds = []
-        ordered_outputs = []
-        for i, batch in enumerate(batches, 1):
-            # print("batch", [self.dataloader.dataset.index2word[w.item()] for w in batch['inputs'][0]])
+    def generate_greedy(self):
+        ''' Generate the (example id, prediction) of each example using greedy search '''
+        for batch in self.dataloader:
             pred = self.generate_batch_greedy(batch['inputs'], batch['input_lens'])
             for i, example_id in enumerate(batch['example_ids']):
-                ordered_outputs.append((example_id, [pred[i]]))
-            # preds.extend(pred)
-            print("output", ordered_outputs[0])
-        print("Evaluation time for {} sentences is {} for checkpoint {}".format(len(self.dataloader.dataset.pairs),
-                                                                                time.time() - start,
-                                                                                self.config['restore']))
-        for _, outputs in sorted(ordered_outputs, key=lambda x: x[0]):  # pylint:disable=consider-using-enumerate
-            preds.extend(outputs)
-        return preds
-
-    def evaluate(self, method):
+                yield example_id, pred[i]
+
+    def evaluate(self, method, writer=None):
+        '''
+        Evaluate the split using the given search method. Returns the predictions in example order,
+        unless a writer is passed, in which case each prediction is handed to the writer as soon as it
+        is generated instead.
+        '''
         if method == 'greedy':
-            return self.evaluate_greedy()
+            outputs = self.generate_greedy()
         elif method == 'beam':
-            return self.evaluate_beam()
+            outputs = self.generate_beam()
         else:
             raise ValueError("Unknown evaluate method!!")
 
+        start = time.time()
+        count = 0
+        ordered_outputs = []
+        for example_id, pred in outputs:
+            count += 1
+            if writer is None:
+                ordered_outputs.append((example_id, pred))
+            else:
+                writer.write(example_id, pred)
+
+        print("Evaluation time for {} sentences is {} for checkpoint {}".format(count,
+                                                                                time.time() - start,
+                                                                                self.config['restore']))
+
+        if isinstance(self.dataloader, Prefetcher):
+            for name, value in self.dataloader.summary().items():
+                print(name, value)
+            self.dataloader.reset_stats()
+
+        if writer is None:
+            return [pred for _, pred in sorted(ordered_outputs, key=lambda x: x[0])]
+
     def restore_checkpoint(self, restore_path):
         if restore_path is not None:
             if self.config['average_checkpoints']:
@@ -10,7 +10,11 @@ import psutil
 from torch import nn, optim
 from torch.autograd import Variable
 from model import SOS_token, EOS_token, DEVICE, PAD_token
-from model.utils import save_plot, time_since, debug_memory, tqdm_wrap_stdout, Parallel, LabelSmoothingLoss
+from data.cache import BatchCache
+from data.collate import split_batch
+from data.prefetch import Prefetcher
+from model.utils import save_plot, time_since, debug_memory, tqdm_wrap_stdout, Parallel, LabelSmoothingLoss, \
+    ChunkedDataParallel
 
 # config: max_length, span_size, teacher_forcing_ratio, learning_rate, num_iters, print_every, plot_every, save_path,
 #         restore_path, best_save_path, plot_path, minibatch_size, optimizer
@@ -72,13 +76,31 @@ class Trainer(object):
         self.dataset = dataloader.dataset
         self.experiment = experiment
         self.dataloader_valid = dataloader_valid
+        if dataloader_valid is not None and config['valid_cache'] != 'none':
+            # Collate the validation batches once, then replay them every epoch
+            self.dataloader_valid = BatchCache(
+                dataloader_valid,
+                DEVICE if config['valid_cache'] == 'device' and 'cuda' in DEVICE.type else None
+            )
         self.metric_store = {'oom': 0}
+        # The adaptive token budget of the training batches, if any
+        self.budget = getattr(getattr(dataloader, 'batch_sampler', None), 'budget', None)
 
         if 'cuda' in DEVICE.type:
-            self.encoder = nn.DataParallel(self.encoder)
-            self.decoder = nn.DataParallel(self.decoder)
+            # Keep the input lengths on the CPU, where pack_padded_sequence needs them
+            self.encoder = ChunkedDataParallel(self.encoder, host_args=(1,))
+            self.decoder = ChunkedDataParallel(self.decoder, host_kwargs=('input_lens',))
             self.criterion.should_unsqueeze = True
-            self.criterion = nn.DataParallel(self.criterion)
+            self.criterion = ChunkedDataParallel(self.criterion)
+
+    def chunk_kwargs(self, module, batch, rows_per_example=1):
+        '''
+        Scatter the batch across the replicas of the module in its chunk sizes, if it has any. Pass
+        the rows_per_example of inputs which are flattened to one row per token of each example.
+        '''
+        if isinstance(module, ChunkedDataParallel) and 'chunk_sizes' in batch:
+            return {'chunk_sizes': [size * rows_per_example for size in batch['chunk_sizes']]}
+        return {}
 
     def train_batch(self, batch):
         """
@@ -92,29 +114,31 @@ class Trainer(object):
 
         # Run words through encoder
         # Make sure inputs are all gathered to be the longest length of the input, or else error will occur
-        encoder_outputs, encoder_hidden, encoder_cell = self.encoder(batch['inputs'], batch['input_lens'], batch['inputs'].size()[1])
+        encoder_outputs, encoder_hidden, encoder_cell = self.encoder(batch['inputs'], batch['input_lens'], batch['inputs'].size()[1],
+                                                                     **self.chunk_kwargs(self.encoder, batch))
 
-        decoder_hidden = torch.zeros(self.config['num_layers'] + 1 + self.config['more_decoder_layers'], batch['inputs'].size()[0], self.config['hidden_size'],
-                                     device=DEVICE)
-        decoder_cell = torch.zeros(self.config['num_layers'] + 1 + self.config['more_decoder_layers'], batch['inputs'].size()[0], self.config['hidden_size'],
-                                   device=DEVICE)
+        decoder_hidden, decoder_cell = getattr(self.decoder, 'module', self.decoder).zero_state(batch['inputs'].size()[0])
 
         decoder_outputs = []
 
         use_teacher_forcing = True if random.random() < self.config['teacher_forcing_ratio'] else False
         # print("targets", batch['targets'])
         if use_teacher_forcing:
-            for i in range(0, (batch['span_seq_len'] - 1) * self.config['span_size'], self.config['span_size']):
-                decoder_output, decoder_hidden, decoder_cell, decoder_attn = self.decoder(batch['targets'][:, i:i+self.config['span_size']],
-                                                                                          decoder_hidden, decoder_cell, encoder_outputs)
-                decoder_outputs.append(decoder_output)
-            decoder_outputs = torch.cat(decoder_outputs, dim=1)
+            # Decode all the spans at once rather than one span at a time
+            decoder_outputs, decoder_hidden, decoder_cell, decoder_attn = self.decoder(
+                batch['targets'][:, :(batch['span_seq_len'] - 1) * self.config['span_size']],
+                decoder_hidden, decoder_cell, encoder_outputs, full_sequence=True, input_lens=batch['input_lens'],
+                **self.chunk_kwargs(self.decoder, batch)
+            )
         else:
             batch_size = len(batch['inputs'])
             decoder_input = torch.tensor([SOS_token] * self.config['span_size'] * batch_size, device=DEVICE).view(batch_size, -1)
+            # Project the attention keys and values once rather than at every step
+            attention_state = getattr(self.decoder, 'module', self.decoder).init_state(encoder_outputs, batch['input_lens'])
             for i in range(0, (batch['span_seq_len'] - 1) * self.config['span_size'], self.config['span_size']):
                 decoder_output, decoder_hidden, decoder_cell, decoder_attn = self.decoder(decoder_input,
-                                                                            decoder_hidden, decoder_cell, encoder_outputs)
+                                                                            decoder_hidden, decoder_cell, attention_state,
+                                                                            **self.chunk_kwargs(self.decoder, batch))
                 topv, topi = decoder_output.topk(1, dim=2)
                 # print("topi", topi.size())
                 decoder_input = topi.squeeze(2)
@@ -124,18 +148,81 @@ class Trainer(object):
         # print("decoder_outputs", decoder_outputs.size())
         # print("targets", batch['targets'].size())
         smoothed_nll, nll = self.criterion(decoder_outputs.view(-1, self.dataset.num_words),
-                              batch['targets'][:, self.config['span_size']:].contiguous().view(-1))
+                              batch['targets'][:, self.config['span_size']:].contiguous().view(-1),
+                              **self.chunk_kwargs(self.criterion, batch, decoder_outputs.size()[1]))
 
         nll = nll.sum()
         smoothed_nll = smoothed_nll.sum()
         smoothed_nll.backward()
-        nn.utils.clip_grad_norm_(self.encoder.parameters(), self.config['clip'])
-        nn.utils.clip_grad_norm_(self.decoder.parameters(), self.config['clip'])
         # self.lr_scheduler.step()
 
         return smoothed_nll.item(), torch.sum(batch['target_lens']).item()
 
+    def train_batch_adaptive(self, batch):
+        '''
+        Train a batch, adapting the token budget to the memory usage. When the batch runs out of
+        memory, shrink the budget and train the batch in halves rather than dropping it. Running out
+        of memory during the backward pass may leave part of the gradients of the batch added, so the
+        gradients accumulated before the batch are restored first. The gradients of the halves then
+        add up to those of the whole batch. If the batch cannot be trained even in halves, the
+        gradients are restored before raising, so the dropped batch contributes nothing.
+        '''
+        gradients = self.save_gradients()
+        try:
+            result = self.train_batch(batch)
+        except RuntimeError as rte:
+            self.restore_gradients(gradients)
+            if 'out of memory' not in str(rte) or batch['batch_size'] == 1:
+                raise
+
+            torch.cuda.empty_cache()
+            self.metric_store['oom'] += 1
+            self.log_budget(self.budget.shrink('out of memory'))
+
+            loss, total_length = 0, 0
+            try:
+                for chunk in split_batch(batch, 2, self.config['span_size']):
+                    chunk_loss, chunk_length = self.train_batch_adaptive(chunk)
+                    loss += chunk_loss
+                    total_length += chunk_length
+            except RuntimeError:
+                # Drop the gradients of the halves which did fit
+                self.restore_gradients(gradients)
+                raise
+
+            return loss, total_length
+
+        self.log_budget(self.budget.step())
+        return result
+
+    def parameters(self):
+        ''' Get the parameters of the encoder and decoder '''
+        return list(self.encoder.parameters()) + list(self.decoder.parameters())
+
+    def save_gradients(self):
+        ''' Copy the gradients accumulated so far '''
+        return [
+            param.grad.clone() if param.grad is not None else None
+            for param in self.parameters()
+        ]
+
+    def restore_gradients(self, gradients):
+        '''
+        Restore gradients copied by save_gradients. They are copied again, so later backward passes
+        never add into the saved gradients, which may be restored more than once.
+        '''
+        for param, gradient in zip(self.parameters(), gradients):
+            param.grad = gradient.clone() if gradient is not None else None
+
+    def log_budget(self, changed):
+        ''' Log the token budget if it changed '''
+        if changed and self.experiment is not None:
+            self.experiment.log_metric('token_budget', self.budget.tokens)
+
     def optimize(self):
+        # Clip the gradients of the whole update, however many batches they were accumulated over
+        nn.utils.clip_grad_norm_(self.encoder.parameters(), self.config['clip'])
+        nn.utils.clip_grad_norm_(self.decoder.parameters(), self.config['clip'])
         self.lr_scheduler.step()
         self.optimizer.step()
         self.optimizer.zero_grad()
@@ -154,7 +241,23 @@ class Trainer(object):
         oom = self.metric_store['oom']
 
         batches = self.dataloader
-        len_batches = len(batches)
+        sampler = getattr(batches, 'batch_sampler', None)
+        if hasattr(sampler, 'set_epoch') and sampler.epoch != epoch:
+            # Unless resuming the epoch from a checkpoint, start it from the beginning
+            sampler.set_epoch(epoch)
+
+        # Resuming the epoch, the sampler skips the batches consumed before the checkpoint, so keep
+        # counting the steps from there
+        consumed = getattr(sampler, 'position', 0)
+
+        # A streamed split has no sampler state to resume from, so only checkpoint the whole epoch
+        save_checkpoint_every = self.config['save_checkpoint_every'] if hasattr(sampler, 'state_dict') else 0
+
+        try:
+            len_batches = len(batches)
+        except TypeError:
+            # A streaming dataset does not know how many batches it has ahead of time
+            len_batches = -1
 
         accumulated_loss = 0
         accumulated_loss_n = 0
@@ -175,7 +278,7 @@ class Trainer(object):
             return False
 
         # with tqdm_wrap_stdout():
-        for i, batch in enumerate(batches, 1):
+        for i, batch in enumerate(batches, consumed + 1):
             # print("now in batch", i)
 
             self.step = i
@@ -184,10 +287,16 @@ class Trainer(object):
             try:
                 # print("train now")
                 torch.cuda.empty_cache()
-                loss, total_length = self.train_batch(batch)
+                if self.budget is not None:
+                    loss, total_length = self.train_batch_adaptive(batch)
+                else:
+                    loss, total_length = self.train_batch(batch)
                 did_optimize = try_optimize(i, i == len_batches)
                 if self.experiment is not None and did_optimize:
                     self.experiment.set_step(self.experiment.curr_step + 1)
+                if did_optimize and i != len_batches and save_checkpoint_every \
+                        and i % save_checkpoint_every == 0:
+                    self.save_checkpoint(self.checkpoint_state(epoch, sampler, i, len_batches), 'last')
                 # GPUtil.showUtilization()
 
                 epoch_loss += loss
@@ -220,14 +329,24 @@ class Trainer(object):
                     print(message)
                     return -1
 
+        if len_batches < 0 and self.step > 0:
+            # Apply any remaining accumulated gradients
+            try_optimize(self.step, True)
+
+        padding_ratio = getattr(sampler, 'padding_ratio', None)
+        if self.experiment is not None and padding_ratio is not None:
+            self.experiment.log_metric('padding_ratio', padding_ratio)
+
+        if isinstance(batches, Prefetcher):
+            # A long wait for batches means the model is starved by the input pipeline
+            for name, value in batches.summary().items():
+                print(name, value)
+                if self.experiment is not None:
+                    self.experiment.log_metric(name, value)
+            batches.reset_stats()
+
         print("now save")
-        self.save_checkpoint({
-            'epoch': epoch,
-            'encoder_state': self.encoder.state_dict(),
-            'decoder_state': self.decoder.state_dict(),
-            'optimizer': self.optimizer.state_dict(),
-            'lr_scheduler': self.lr_scheduler.state_dict()
-        }, epoch)
+        self.save_checkpoint(self.checkpoint_state(epoch, sampler), epoch)
 
         print('%s (%d %d%%) %.10f' % (
             time_since(start, (epoch + 1) / self.config['num_epochs']),
@@ -235,6 +354,32 @@ class Trainer(object):
             epoch_loss), flush=True)
         self.step = -1
 
+    def checkpoint_state(self, epoch, sampler, step=None, len_batches=-1):
+        '''
+        Get the state to checkpoint, either at the end of the epoch, or after the given number of
+        steps into it. A mid-epoch checkpoint resumes the epoch after the consumed steps, if the
+        steps map one to one onto the batches of the sampler. Otherwise, e.g. when the adaptive
+        budget splits batches, it restarts the epoch.
+        '''
+        if step is not None and not hasattr(sampler, 'state_dict'):
+            raise ValueError('Cannot checkpoint mid-epoch without a resumable sampler!')
+
+        state = {
+            'epoch': epoch if step is None else epoch - 1,
+            'step': step,
+            'encoder_state': self.encoder.state_dict(),
+            'decoder_state': self.decoder.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'lr_scheduler': self.lr_scheduler.state_dict()
+        }
+        if hasattr(sampler, 'state_dict'):
+            resumable = step is not None and len_batches >= 0
+            state['sampler'] = sampler.state_dict(step if resumable else 0)
+            if step is not None and not resumable:
+                state['sampler']['epoch'] = epoch - 1
+
+        return state
+
     def train(self):
         if self.experiment is not None:
             self.experiment.set_step(0)
@@ -248,11 +393,14 @@ class Trainer(object):
                 #     self.lr_scheduler.step()
 
     def evaluate_nll(self):
-        batches = self.dataloader
+        batches = self.dataloader_valid
 
         accumulated_loss = 0
         accumulated_loss_n = 0
 
+        self.encoder.eval()
+        self.decoder.eval()
+
         # with tqdm_wrap_stdout():
         for i, batch in enumerate(batches, 1):
             try:
@@ -271,8 +419,15 @@ class Trainer(object):
                     template = "An exception of type {0} occurred. Arguments:\n{1!r}"
                     message = template.format(type(rte).__name__, rte.args)
                     print(message)
+                    self.encoder.train()
+                    self.decoder.train()
                     return -1
-        valid_nll = accumulated_loss / accumulated_loss_n
+
+        self.encoder.train()
+        self.decoder.train()
+
+        # Only wait for the device once, rather than after every batch
+        valid_nll = float(accumulated_loss) / accumulated_loss_n
         if self.experiment is not None:
             self.experiment.log_metric("valid_nll", valid_nll)
         print("Validation NLL:", valid_nll)
@@ -285,29 +440,22 @@ class Trainer(object):
         :return:
         """
         with torch.no_grad():
-            self.encoder.eval()
-            self.decoder.eval()
-
             # Run words through encoder
-            encoder_outputs, encoder_hidden, encoder_cell = self.encoder(batch['inputs'].to(device=DEVICE), batch['input_lens'], batch['inputs'].size()[1])
-
-            decoder_hidden = torch.zeros(self.config['num_layers'] + 1 + self.config['more_decoder_layers'], batch['inputs'].size()[0],
-                                         self.config['hidden_size'], device=DEVICE)
-            decoder_cell = torch.zeros(self.config['num_layers'] + 1 + self.config['more_decoder_layers'], batch['inputs'].size()[0],
-                                       self.config['hidden_size'], device=DEVICE)
-            decoder_outputs = []
-            for i in range(0, (batch['span_seq_len'] - 1) * self.config['span_size'], self.config['span_size']):
-                decoder_output, decoder_hidden, decoder_cell, decoder_attn = self.decoder(batch['targets'][:, i:i+self.config['span_size']],
-                                                                            decoder_hidden, decoder_cell, encoder_outputs)
-                decoder_outputs.append(decoder_output)
-            decoder_outputs = torch.cat(decoder_outputs, dim=1)
+            encoder_outputs, encoder_hidden, encoder_cell = self.encoder(batch['inputs'].to(device=DEVICE), batch['input_lens'], batch['inputs'].size()[1],
+                                                                         **self.chunk_kwargs(self.encoder, batch))
+
+            decoder_hidden, decoder_cell = getattr(self.decoder, 'module', self.decoder).zero_state(batch['inputs'].size()[0])
+            decoder_outputs, decoder_hidden, decoder_cell, decoder_attn = self.decoder(
+                batch['targets'][:, :(batch['span_seq_len'] - 1) * self.config['span_size']],
+                decoder_hidden, decoder_cell, encoder_outputs, full_sequence=True, input_lens=batch['input_lens'],
+                **self.chunk_kwargs(self.decoder, batch)
+            )
             smoothed_nll, nll = self.criterion(decoder_outputs.view(-1, self.dataset.num_words),
-                                               batch['targets'][:, self.config['span_size']:].contiguous().view(-1))
+                                               batch['targets'][:, self.config['span_size']:].contiguous().view(-1),
+                                               **self.chunk_kwargs(self.criterion, batch, decoder_outputs.size()[1]))
 
-            loss = smoothed_nll
-            self.encoder.train()
-            self.decoder.train()
-            return loss.item(), torch.sum(batch['target_lens']).item()
+            # The target lengths are on the CPU, but leave the loss on the device
+            return smoothed_nll.sum(), torch.sum(batch['target_lens']).item()
 
     def restore_checkpoint(self, restore_path):
         if restore_path is not None:
@@ -322,11 +470,18 @@ class Trainer(object):
                     self.lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
                 except:
                     print("exception when loading state dict to optimizer and lr scheduler")
+
+                sampler = getattr(self.dataloader, 'batch_sampler', None)
+                if 'sampler' in checkpoint and hasattr(sampler, 'load_state_dict'):
+                    sampler.load_state_dict(checkpoint['sampler'])
                 print("=> loaded checkpoint '{}' (epoch {})".format(restore_path, checkpoint['epoch']))
             else:
                 print("=> no checkpoint found at '{}'".format(restore_path))
 
     def save_checkpoint(self, state, epoch):
-        torch.save(state, self.config['experiment_path'] + self.config['save_path'] + str(epoch) + ".pth.tar")
+        path = self.config['experiment_path'] + self.config['save_path'] + str(epoch) + ".pth.tar"
+        # Write the checkpoint atomically, so an interrupted save never leaves a truncated checkpoint
+        torch.save(state, path + '.incomplete')
+        os.replace(path + '.incomplete', path)
         # if is_best:
         #     shutil.copyfile(self.config['save_path'], self.config['best_save_path'])
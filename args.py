@@ -90,6 +90,15 @@ def add_train_args(parser):
         help='Whether or not evaluate when training'
     )
 
+    group.add_argument(
+        '--valid-cache',
+        type=str,
+        default='host',
+        choices=['none', 'host', 'device'],
+        help='Where to keep the validation batches, which are collated once and replayed every epoch. '
+        'If none, load them again every epoch.'
+    )
+
     group.add_argument(
         '--new-lr-scheduler',
         action='store_true',
@@ -140,6 +149,24 @@ def add_evaluate_args(parser):
         help='Default beam width for beam search decoder.'
     )
 
+    group.add_argument(
+        '--decode-batch-size',
+        type=int,
+        default=None,
+        help='Token budget of a decoding batch, counting the source length plus --max-length decoded '
+        'tokens for every hypothesis in the beam, i.e. beam width x (source length + max length) per '
+        'example. Defaults to the beam width times the minibatch size, times twice the max length if '
+        'the batch method counts examples.'
+    )
+
+    group.add_argument(
+        '--decode-window',
+        type=int,
+        default=10000,
+        help='Number of consecutive examples sorted by source length together when decoding, which '
+        'bounds how many predictions are held back to write them in order. 0 sorts the whole split.'
+    )
+
     group.add_argument(
         '--average-checkpoints',
         action='store_true',
@@ -200,7 +227,7 @@ def add_data_args(parser):
         '--batch-method',
         type=str,
         default='token',
-        choices=['token', 'example', 'random_batch'],
+        choices=['token', 'padded_token', 'target_token', 'example', 'random_batch'],
         help='By which method to sample batches'
     )
 
@@ -232,6 +259,72 @@ def add_data_args(parser):
         help='Location for the preprocessed data'
     )
 
+    group.add_argument(
+        '--binarize',
+        action='store_true',
+        help='Binarize each split once into the preprocess directory and memory-map it afterwards'
+    )
+
+    group.add_argument(
+        '--dataset-cache',
+        action='store_false',
+        help='Whether or not to cache the prepared splits in the preprocess directory, keyed by the data '
+             'files and the options used to prepare them'
+    )
+
+    group.add_argument(
+        '--stream',
+        action='store_true',
+        help='Stream the splits line by line rather than loading them into memory'
+    )
+
+    group.add_argument(
+        '--stream-buffer-size',
+        type=int,
+        default=100000,
+        help='Number of examples in the shuffle buffer when streaming'
+    )
+
+    group.add_argument(
+        '--stream-window-size',
+        type=int,
+        default=10000,
+        help='Number of examples sorted together to make batches when streaming'
+    )
+
+    group.add_argument(
+        '--num-workers',
+        type=int,
+        default=1,
+        help='Number of dataloader worker processes. If 0, load the data in the main process'
+    )
+
+    group.add_argument(
+        '--prefetch-factor',
+        type=int,
+        default=2,
+        help='Number of batches loaded in advance by each dataloader worker'
+    )
+
+    group.add_argument(
+        '--prefetch-batches',
+        type=int,
+        default=0,
+        help='Number of batches staged onto the device in advance by a background thread. If 0, do not prefetch'
+    )
+
+    group.add_argument(
+        '--persistent-workers',
+        action='store_true',
+        help='Keep the dataloader workers alive across epochs rather than respawning them'
+    )
+
+    group.add_argument(
+        '--pin-workers',
+        action='store_true',
+        help='Pin each dataloader worker to its own CPU'
+    )
+
     group.add_argument(
         '--preprocess-buffer-size',
         type=int,
@@ -239,6 +332,92 @@ def add_data_args(parser):
         help='Number of lines to preprocess at once'
     )
 
+    group.add_argument(
+        '--preprocess-workers',
+        type=int,
+        default=0,
+        help='Number of processes used to binarize the splits, shared across splits. If 0, split the CPUs '
+        'evenly across the ranks'
+    )
+
+    group.add_argument(
+        '--rank',
+        type=int,
+        default=0,
+        help='Rank of this process when sharding the training batches across processes'
+    )
+
+    group.add_argument(
+        '--world-size',
+        type=int,
+        default=1,
+        help='Number of processes the training batches are sharded across'
+    )
+
+    group.add_argument(
+        '--shard-corpus',
+        action='store_true',
+        help='Have each process only load its own token balanced shard of the binarized training '
+        'split, rather than the whole split'
+    )
+
+    group.add_argument(
+        '--adaptive-budget',
+        action='store_true',
+        help='Adapt the token budget of the training batches to the available memory, rather than '
+        'dropping batches which run out of memory'
+    )
+
+    group.add_argument(
+        '--memory-high-water',
+        type=float,
+        default=0.9,
+        help='Fraction of the host memory limit or device memory used by this process above which the '
+        'adaptive token budget shrinks'
+    )
+
+    group.add_argument(
+        '--host-memory-limit',
+        type=float,
+        default=None,
+        help='The host memory in GiB this process may use, against which the adaptive token budget '
+        'measures its memory usage. Defaults to all of the host memory.'
+    )
+
+    group.add_argument(
+        '--balance-devices',
+        action='store_true',
+        help='Split each training batch into a sub-batch per device, balancing their padded token cost'
+    )
+
+    return group
+
+
+def add_placement_args(parser):
+    group = parser.add_argument_group('Placement')
+
+    group.add_argument(
+        '--placement',
+        action='store_true',
+        help='Place the main process, the data workers and the decode workers on their own CPUs of a '
+        'single NUMA node, and set the number of threads of each. Supersedes --pin-workers.'
+    )
+
+    group.add_argument(
+        '--placement-node',
+        type=int,
+        default=None,
+        help='NUMA node to place the processes on. Defaults to the rank, so each process of a run '
+        'gets its own node.'
+    )
+
+    group.add_argument(
+        '--inter-op-threads',
+        type=int,
+        default=1,
+        help='Number of inter-op threads of the main process when placed'
+    )
+
     return group
 
 
@@ -291,6 +470,7 @@ def get_cl_args():
     groups['train'] = add_train_args(arg_parser)
     groups['evaluate'] = add_evaluate_args(arg_parser)
     groups['cuda'] = add_cuda_args(arg_parser)
+    groups['placement'] = add_placement_args(arg_parser)
 
 
     return arg_parser.parse_args()
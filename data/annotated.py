@@ -1,7 +1,11 @@
 import re
 import os
 import enum
-from data.text import TextDataset, SOS
+from contextlib import ExitStack
+
+import utils.file as file_utils
+from data.text import TextDataset
+from data.vocab import Vocabulary
 from data import preprocess
 
 
@@ -48,14 +52,16 @@ class AnnotatedTextDataset(TextDataset):
     IGNORE_REGEX_LIST = []
     SEGMENT_REGEX = re.compile(r'<\s*seg\s+id\s*=\s*"\d+"\s*>\s*(.+)\s*<\s*/\s*seg\s*>')
 
-    def __init__(self, config, max_length, span_size, filter, split="train", reverse=False, trim=False, annotation=TextAnnotation.NONE):
-        super(AnnotatedTextDataset, self).__init__(max_length, span_size, filter, split, reverse, trim)
-
+    def __init__(self, config, max_length, span_size, filter, split="train", reverse=False, trim=False,
+                 annotation=TextAnnotation.NONE, **kwargs):
+        # Needed by prepare_data, which is called from the base initializer
         self.segmenters = []
         self.annotation = annotation
         self.preprocess_directory = config['preprocess_directory']
         self.config = config
 
+        super(AnnotatedTextDataset, self).__init__(max_length, span_size, filter, split, reverse, trim, **kwargs)
+
     @classmethod
     def name(cls, reverse=False, annotation=TextAnnotation.NONE):
         ''' Return a name for the dataset given the passed in configuration '''
@@ -110,6 +116,14 @@ class AnnotatedTextDataset(TextDataset):
             self.target_annotation_data_path
         }
 
+    @property
+    def binary_path(self):
+        ''' Get the path prefix of the binarized split '''
+        return os.path.join(
+            self.preprocess_directory,
+            f'{type(self).name(self.reverse, self.annotation)}.{self.binary_name}'
+        )
+
     @property
     def base_vocab_path(self):
         ''' Get the path of the vocab file '''
@@ -164,8 +178,17 @@ class AnnotatedTextDataset(TextDataset):
                 TextAnnotation.CONSTITUENCY_PARSE
         ):
             base_annotation_id = len(self.index2word)
+            annotations = set()
             for filename in type(self).SPLITS.values():
-                self.preprocess_parse(filename)
+                annotations.update(self.preprocess_parse(filename))
+
+            # Extend the training vocabulary once with the annotations of every split, so all the
+            # splits share the same ids. A vocabulary shared from another split already has them.
+            words = self.index2word.tolist()
+            annotations = sorted(annotations.difference(words))
+            if annotations:
+                # The vocabulary is immutable, so extend it by creating a new one
+                self.vocab = Vocabulary.from_words(words + annotations)
 
             if not os.path.exists(self.constituent_vocab_path):
                 with open(self.constituent_vocab_path, 'wt') as file:
@@ -175,7 +198,7 @@ class AnnotatedTextDataset(TextDataset):
                     ]))
 
     def preprocess_parse(self, filename):
-        ''' Preprocess the parse data '''
+        ''' Preprocess the parse data, returning the set of annotations it needs in the vocabulary '''
         base_path = os.path.join(self.preprocess_directory, f'{filename}')
         tokenized_bpe_path = f'{base_path}.bpe.32000'
 
@@ -196,7 +219,7 @@ class AnnotatedTextDataset(TextDataset):
             )
 
         if os.path.exists(self.constituent_vocab_path):
-            return
+            return set()
 
         bpe_path = os.path.join(self.preprocess_directory, 'bpe.32000')
         self.segmenters = [
@@ -215,10 +238,7 @@ class AnnotatedTextDataset(TextDataset):
             self.segmenters, self.config['preprocess_buffer_size']
         ))
 
-        for token in vocab:
-            if token not in self.word2index:
-                self.word2index[token] = len(self.index2word)
-                self.index2word.append(token)
+        return vocab
 
     def load(self, preprocess=True):
         if preprocess:
@@ -227,36 +247,33 @@ class AnnotatedTextDataset(TextDataset):
 
     def read_vocab(self):
         vocab = open(self.DIR_PATH + self.VOCAB_FILE, 'r').read().strip().split('\n')
-        for v in vocab:
-            self.add_word(v.split()[0])
-
-    def read_langs(self):
-        print("Reading lines...")
-        if self.split != "test":
-            l2_lines = open(self.DIR_PATH + '%s.' + self.LANGUAGE_PAIR[1] % (self.SPLITS[self.split])).read().strip().split('\n')
-        l1_lines = open(self.DIR_PATH + '%s.' + self.LANGUAGE_PAIR[0] % (self.SPLITS[self.split])).read().strip().split('\n')
-
-        # Split every line into pairs
-        if self.split != "test":
-            if self.reverse:
-                pairs = [[s2, (SOS + ' ') * self.span_size + s1] for s1, s2 in zip(l1_lines, l2_lines)]
-            else:
-                pairs = [[s1, (SOS + ' ') * self.span_size + s2] for s1, s2 in zip(l1_lines, l2_lines)]
-        else:
-            pairs = [[s, ""]for s in l1_lines]
-
-        # print("pairs[0]", pairs[0])
+        return [v.split()[0] for v in vocab]
 
-        print("Read %s sentence pairs in %s" % (len(pairs), self.split))
-
-        if self.filter:
-            pairs = self.filter_pairs(pairs)
-
-        if self.trim:
-            print("Trimmed to max_length")
-            pairs = self.trim_pairs(pairs)
+    @property
+    def split_paths(self):
+        ''' Get the paths of the text files of the split '''
+        paths = [self.DIR_PATH + '%s.%s' % (self.SPLITS[self.split], lang) for lang in self.LANGUAGE_PAIR]
+        if self.split == "test":
+            # The test split has no references
+            paths = paths[:1]
 
-        print("Trimmed to %s sentence pairs" % len(pairs))
-        # print(len(sorted(pairs, key=lambda x: len(x[1]))[-1][0].split(" ")))
+        return paths
 
-        self.pairs = pairs
+    @property
+    def data_files(self):
+        ''' Get the list of files (including the vocab) the split is prepared from '''
+        return self.split_paths + [self.DIR_PATH + self.VOCAB_FILE]
+
+    def read_lines(self):
+        ''' Lazily yield the (first language, second language) line pairs of the split '''
+        with ExitStack() as stack:
+            files = [stack.enter_context(file_utils.Open(path, 'rt')) for path in self.split_paths]
+            for lines in zip(*files):
+                yield tuple(line.rstrip('\r\n') for line in lines)
+
+    def make_pair(self, lines):
+        ''' Make a (source, target) pair from a (first language, second language) pair of lines '''
+        if self.split == "test":
+            return [lines[0], ""]
+
+        return super(AnnotatedTextDataset, self).make_pair(lines)
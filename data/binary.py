@@ -0,0 +1,159 @@
+'''
+A module implementing a memory-mapped binary token corpus.
+'''
+import os
+import tempfile
+
+import numpy as np
+
+
+def save_array(path, data):
+    '''
+    Save the given array, making sure a partially written file is never picked up. Each process
+    writes its own temporary file, so processes which build the same cache at once, e.g. ranks
+    sharing a preprocess directory, never interleave their writes. The last one to finish wins.
+    '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    fd, incomplete_path = tempfile.mkstemp(
+        prefix=f'{os.path.basename(path)}.', suffix='.incomplete', dir=directory or None
+    )
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, data)
+        os.replace(incomplete_path, path)
+    except BaseException:
+        os.remove(incomplete_path)
+        raise
+
+
+def shard_bounds(lengths, num_shards):
+    '''
+    Split the examples with the given N x 2 length index into num_shards contiguous ranges with
+    about an equal share of the tokens. Returns the num_shards + 1 boundaries of the ranges.
+    '''
+    tokens = np.cumsum(lengths.astype(np.int64).sum(axis=1))
+    total = tokens[-1] if len(tokens) else 0
+    bounds = np.searchsorted(tokens, total * np.arange(1, num_shards) / num_shards, side='right')
+    return [0] + bounds.tolist() + [len(lengths)]
+
+
+class BinaryCorpus(object):
+    '''
+    A parallel corpus stored as flat token arrays (uint16 when the vocabulary fits), plus int64
+    offsets into those arrays for each example. The arrays are memory-mapped, so getting an example is just a slice of the mapped
+    file rather than any string processing.
+
+    A corpus may also be a shard, the examples in [start, end), in which case only the byte range of
+    the files spanned by those examples is ever mapped or read.
+    '''
+    FIELDS = ('source_tokens', 'source_offsets', 'target_tokens', 'target_offsets')
+
+    def __init__(self, path, start=0, end=None):
+        ''' Initialize the corpus located at the given path prefix '''
+        self.path = path
+        self.start = start
+        self.end = end
+        self.mmap = True
+        self.arrays = None
+
+    def field_path(self, field):
+        ''' Get the path of the file storing the given field '''
+        return f'{self.path}.{field}.npy'
+
+    @property
+    def paths(self):
+        ''' Get the list of files making up the corpus '''
+        return [self.field_path(field) for field in type(self).FIELDS]
+
+    def exists(self):
+        ''' Whether the corpus has already been binarized '''
+        return all(os.path.exists(p) for p in self.paths)
+
+    @classmethod
+    def merge(cls, path, chunks):
+        '''
+        Binarize an iterable of chunks, each a tuple of the flat source tokens, the source lengths,
+        the flat target tokens and the target lengths of its examples, merged in order
+        '''
+        fields = ([], [np.zeros(1, dtype=np.int64)], [], [np.zeros(1, dtype=np.int64)])
+        for chunk in chunks:
+            for field, data in zip(fields, chunk):
+                field.append(data)
+
+        arrays = {}
+        for side, (tokens, lengths) in zip(('source', 'target'), (fields[:2], fields[2:])):
+            arrays[f'{side}_tokens'] = np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int32)
+            arrays[f'{side}_offsets'] = np.cumsum(np.concatenate(lengths), dtype=np.int64)
+
+        corpus = cls(path)
+        corpus.save(arrays)
+
+        return corpus
+
+    def shard(self, start, end):
+        ''' Get the shard of the corpus with the examples in [start, end) '''
+        return type(self)(self.path, self.start + start, self.start + end)
+
+    def save(self, arrays):
+        ''' Save the given arrays '''
+        for field, data in arrays.items():
+            save_array(self.field_path(field), data)
+
+    def open(self, mmap=None):
+        '''
+        Memory-map the corpus (copy-on-write, so the slices can be handed directly to torch), or
+        when mmap is False, read each array into memory in a single bulk read.
+        '''
+        if mmap is not None and mmap != self.mmap:
+            self.mmap = mmap
+            self.arrays = None
+
+        if self.arrays is None:
+            self.arrays = {}
+            for side in ('source', 'target'):
+                offsets = np.load(self.field_path(f'{side}_offsets'), mmap_mode='c' if self.mmap else 'r')
+                tokens = np.load(self.field_path(f'{side}_tokens'), mmap_mode='c' if self.mmap else 'r')
+
+                end = len(offsets) - 1 if self.end is None else self.end
+                offsets = offsets[self.start:end + 1]
+                tokens = tokens[offsets[0]:offsets[-1]]
+                if self.start:
+                    offsets = offsets - offsets[0]
+
+                if not self.mmap:
+                    # A single bulk read of just the range spanned by the examples
+                    offsets = np.array(offsets)
+                    tokens = np.array(tokens)
+
+                self.arrays[f'{side}_offsets'] = offsets
+                self.arrays[f'{side}_tokens'] = tokens
+
+        return self
+
+    def __getstate__(self):
+        ''' Do not pickle the arrays, each process loads the files itself '''
+        return {'path': self.path, 'start': self.start, 'end': self.end, 'mmap': self.mmap, 'arrays': None}
+
+    @property
+    def lengths(self):
+        ''' Get an N x 2 array of the (source, target) lengths of each example '''
+        arrays = self.open().arrays
+        return np.stack((
+            np.diff(arrays['source_offsets']),
+            np.diff(arrays['target_offsets'])
+        ), axis=1).astype(np.int32)
+
+    def __len__(self):
+        ''' Get the number of examples in the corpus '''
+        return len(self.open().arrays['source_offsets']) - 1
+
+    def __getitem__(self, index):
+        ''' Get the (source ids, target ids) of the example at the specified index '''
+        arrays = self.open().arrays
+        return tuple(
+            arrays[f'{side}_tokens'][arrays[f'{side}_offsets'][index]:arrays[f'{side}_offsets'][index + 1]]
+            for side in ('source', 'target')
+        )
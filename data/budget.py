@@ -0,0 +1,68 @@
+'''
+A module implementing a token budget which adapts to the available memory.
+'''
+import psutil
+import torch
+
+
+class TokenBudget(object):
+    '''
+    A token budget which shrinks after running out of memory, or when the peak host or device memory
+    usage crosses a high-water mark, then cautiously grows back towards the max once there has been
+    headroom for a while. This way a run converges on the largest batches the machine can sustain.
+
+    Only the memory of this process counts, so other processes on the same host do not move the
+    budget: its resident set size against host_memory_limit bytes (by default all of the host
+    memory), and its peak allocated device memory against the memory of the device.
+    '''
+    def __init__(self, max_tokens, high_water=0.9, shrink_factor=0.75, grow_factor=1.1, grow_interval=100,
+                 host_memory_limit=None):
+        ''' Initialize the budget '''
+        self.tokens = max_tokens
+        self.max_tokens = max_tokens
+        self.high_water = high_water
+        self.host_memory_limit = host_memory_limit or psutil.virtual_memory().total
+        self.process = psutil.Process()
+        self.shrink_factor = shrink_factor
+        self.grow_factor = grow_factor
+        self.grow_interval = grow_interval
+
+        # The number of steps since the budget last changed
+        self.steps = 0
+
+    def memory_usage(self):
+        ''' Get the fraction of host or device memory in use, whichever is greater, since last called '''
+        usage = self.process.memory_info().rss / self.host_memory_limit
+        if torch.cuda.is_available():
+            total = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+            usage = max(usage, torch.cuda.max_memory_allocated() / total)
+            torch.cuda.reset_peak_memory_stats()
+
+        return usage
+
+    def set_tokens(self, tokens, reason):
+        ''' Set the number of tokens, logging the decision. Returns whether the budget changed. '''
+        tokens = int(min(max(tokens, 1), self.max_tokens))
+        self.steps = 0
+        if tokens == self.tokens:
+            return False
+
+        print("token budget %s -> %s (%s)" % (self.tokens, tokens, reason))
+        self.tokens = tokens
+        return True
+
+    def shrink(self, reason):
+        ''' Shrink the budget '''
+        return self.set_tokens(self.tokens * self.shrink_factor, reason)
+
+    def step(self):
+        ''' Update the budget after a successful step. Returns whether the budget changed. '''
+        self.steps += 1
+        usage = self.memory_usage()
+        if usage > self.high_water:
+            return self.shrink('memory usage %.2f above %.2f' % (usage, self.high_water))
+
+        if self.steps >= self.grow_interval and self.tokens < self.max_tokens:
+            return self.set_tokens(self.tokens * self.grow_factor, 'memory usage %.2f' % usage)
+
+        return False
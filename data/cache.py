@@ -0,0 +1,72 @@
+'''
+A module implementing a cache of collated batches.
+'''
+import torch
+
+from data.prefetch import Prefetcher
+
+
+class BatchCache(object):
+    '''
+    Wraps a dataloader and keeps its batches as ready to use padded tensors the first time it is
+    iterated, so replaying them, e.g. the validation set every epoch, only costs the forward passes
+    rather than getting, sorting and padding the examples again. The inputs and targets are kept on
+    the given CUDA device, if any, otherwise in (pinned when using CUDA) host memory. The batches are
+    replayed as is, so every iteration gets the batches and order of the first one, even if the
+    dataloader shuffles. The training script builds the validation dataloader without shuffling.
+    '''
+    def __init__(self, dataloader, device=None):
+        ''' Initialize the cache '''
+        self.dataloader = dataloader
+        self.device = device
+        self.batches = None
+
+    def __getattr__(self, name):
+        ''' Any missing attributes get forwarded to the underlying dataloader '''
+        if name.startswith('__') or name == 'dataloader':
+            raise AttributeError(name)
+
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        ''' Get the number of batches '''
+        if self.batches is None:
+            return len(self.dataloader)
+
+        return len(self.batches)
+
+    def copy(self, key, value):
+        '''
+        Copy a batch entry out of the buffers the collator reuses. Only the inputs and targets are
+        moved to the device, the lengths stay on the CPU.
+        '''
+        if not torch.is_tensor(value):
+            return value
+
+        if self.device is not None and key in Prefetcher.DEVICE_KEYS and value.device.type == 'cpu':
+            return value.to(self.device)
+
+        if value.device.type != 'cpu':
+            # Already staged onto the device by a prefetcher, so not in a reused buffer
+            return value
+
+        value = value.clone()
+        if torch.cuda.is_available():
+            value = value.pin_memory()
+
+        return value
+
+    def load(self):
+        ''' Collate and keep all the batches '''
+        self.batches = [
+            {key: self.copy(key, value) for key, value in batch.items()}
+            for batch in self.dataloader
+        ]
+        print("Cached %d batches" % len(self.batches))
+
+    def __iter__(self):
+        ''' Iterate over the cached batches '''
+        if self.batches is None:
+            self.load()
+
+        return iter(self.batches)
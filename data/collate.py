@@ -0,0 +1,174 @@
+'''
+A module implementing batch collation into reusable padded buffers.
+'''
+import os
+import itertools
+import collections.abc
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+
+class Collator(object):
+    '''
+    Collates examples into a padded batch by writing the token ids straight into preallocated
+    buffers, rather than padding each sequence into freshly allocated tensors. The examples may be
+    tensors or compact numpy arrays. The targets are stored without the span_size start tokens the
+    decoder is first fed, so they are prepended here.
+
+    With a ring_size, the buffers are taken in turn from a ring of ring_size reusable buffer sets. In
+    dataloader workers they live in shared memory, so sending a batch to the main process only
+    sends a handle the main process has already mapped. Shared memory cannot be pinned, so the
+    dataloader still has to copy those batches into pinned memory if asked to. In the main process
+    the buffers are pinned if requested, so the dataloader need not pin them again. A batch is
+    overwritten ring_size batches later, so the ring must be larger than max_in_flight, the number
+    of batches which can be in flight at once.
+    '''
+    def __init__(self, padding_idx, sos_idx, span_size, ring_size=0, pin_memory=False, max_in_flight=0):
+        ''' Initialize the collator '''
+        if ring_size and ring_size <= max_in_flight:
+            raise ValueError(
+                f'A ring of {ring_size} buffers would be overwritten while {max_in_flight} batches are in flight!'
+            )
+
+        self.padding_idx = padding_idx
+        self.sos_idx = sos_idx
+        self.span_size = span_size
+        self.ring_size = ring_size
+        self.pin_memory = pin_memory
+
+        self.pid = None
+        self.ring = []
+        self.ring_idx = 0
+
+    def allocate(self, numel):
+        ''' Allocate a flat buffer of the given number of elements '''
+        tensor = torch.empty(numel, dtype=torch.long)
+        if get_worker_info() is not None:
+            tensor.share_memory_()
+        elif self.pin_memory and torch.cuda.is_available():
+            tensor = tensor.pin_memory()
+
+        return tensor
+
+    def buffers(self, sizes):
+        ''' Get the next set of buffers, each with at least the given number of elements '''
+        if not self.ring_size:
+            return [self.allocate(size) for size in sizes]
+
+        if self.pid != os.getpid():
+            # Buffers allocated before forking a worker are not shared, so start a new ring
+            self.pid = os.getpid()
+            self.ring = [[] for _ in range(self.ring_size)]
+            self.ring_idx = 0
+
+        buffers = self.ring[self.ring_idx]
+        if len(buffers) != len(sizes):
+            buffers = [None] * len(sizes)
+
+        buffers = [
+            buffer if buffer is not None and buffer.numel() >= size else self.allocate(size)
+            for buffer, size in zip(buffers, sizes)
+        ]
+        self.ring[self.ring_idx] = buffers
+        self.ring_idx = (self.ring_idx + 1) % self.ring_size
+
+        return buffers
+
+    def pad(self, buffer, sequences, lengths, width, offset=0):
+        '''
+        Write the sequences into a contiguous batch_size x width view of the buffer, each after
+        offset start tokens. The lengths include the start tokens.
+        '''
+        padded = buffer[:len(sequences) * width].view(len(sequences), width)
+
+        array = padded.numpy()
+        array.fill(self.padding_idx)
+        array[:, :offset] = self.sos_idx
+
+        positions = np.arange(width)
+        array[(positions >= offset) & (positions < lengths[:, None])] = np.concatenate([
+            sequence.numpy() if torch.is_tensor(sequence) else sequence
+            for sequence in sequences
+        ])
+
+        return padded
+
+    def make_batch(self, example_ids, inputs, targets):
+        ''' Make a batch given a list of inputs and targets '''
+        batch_size = len(targets)
+        input_lens = np.array([len(input) for input in inputs], dtype=np.int64)
+        target_lens = np.array([len(target) for target in targets], dtype=np.int64) + self.span_size
+
+        # Targets are padded to a whole number of spans
+        span_seq_len = int((target_lens.max() - 1) / self.span_size) + 1
+        input_width = int(input_lens.max())
+        target_width = span_seq_len * self.span_size
+
+        input_buffer, target_buffer, input_lens_buffer, target_lens_buffer = self.buffers([
+            batch_size * input_width, batch_size * target_width, batch_size, batch_size
+        ])
+        input_lens_buffer[:batch_size].numpy()[:] = input_lens
+        target_lens_buffer[:batch_size].numpy()[:] = target_lens
+
+        return {
+            'inputs': self.pad(input_buffer, inputs, input_lens, input_width),
+            'input_lens': input_lens_buffer[:batch_size],
+            'targets': self.pad(target_buffer, targets, target_lens, target_width, self.span_size),
+            'target_lens': target_lens_buffer[:batch_size],
+            'example_ids': example_ids,
+            'batch_size': batch_size,
+            'span_seq_len': span_seq_len
+        }
+
+    def __call__(self, data, sort=False):
+        ''' Collate the data into a batch '''
+        if not data:
+            return []
+
+        if any(
+                isinstance(d, tuple) and len(d) and
+                isinstance(d[0], collections.abc.Sequence)
+                for d in data
+        ):
+            if sort:
+                # Sort within each chunk
+                data = [sorted(d, key=lambda x: len(x[1]), reverse=True) for d in data]
+
+            batch = self.make_batch(*zip(*list(itertools.chain.from_iterable(data))))
+            batch['chunk_sizes'] = [len(l) for l in data]
+            return batch
+        else:
+            if sort:
+                data = sorted(data, key=lambda x: len(x[1]), reverse=True)
+
+            return self.make_batch(*zip(*data))
+
+
+def split_batch(batch, num_chunks, span_size):
+    '''
+    Split a collated batch into at most num_chunks smaller batches, trimming the padding each chunk
+    no longer needs. The examples stay in order, so a batch sorted by length remains sorted.
+    '''
+    batch_size = batch['batch_size']
+    chunk_size = -(-batch_size // num_chunks)
+
+    chunks = []
+    for start in range(0, batch_size, chunk_size):
+        end = min(start + chunk_size, batch_size)
+        input_lens = batch['input_lens'][start:end]
+        target_lens = batch['target_lens'][start:end]
+        span_seq_len = int((target_lens.max().item() - 1) / span_size) + 1
+
+        chunks.append({
+            'inputs': batch['inputs'][start:end, :input_lens.max().item()],
+            'input_lens': input_lens,
+            'targets': batch['targets'][start:end, :span_seq_len * span_size],
+            'target_lens': target_lens,
+            'example_ids': batch['example_ids'][start:end],
+            'batch_size': end - start,
+            'span_seq_len': span_seq_len
+        })
+
+    return chunks
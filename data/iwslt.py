@@ -4,6 +4,7 @@ from data.annotated import AnnotatedTextDataset
 
 class IWSLTDataset(AnnotatedTextDataset):
     """ CLass that encapsulates IWSLT Dataset"""
+    NAME = 'iwslt'
     DIR_PATH = "/mnt/nfs/work1/miyyer/wyou/iwslt/"
     LANGUAGE_PAIR = ('de', 'en')
 
@@ -17,5 +18,5 @@ class IWSLTDataset(AnnotatedTextDataset):
     """
     Prepare data from IWSLTDataset
     """
-    def __init__(self, config, max_length, span_size, filter, split="train", reverse=False, trim=False):
-        super(IWSLTDataset, self).__init__(config, max_length, span_size, filter, split, reverse, trim)
+    def __init__(self, config, max_length, span_size, filter, split="train", reverse=False, trim=False, **kwargs):
+        super(IWSLTDataset, self).__init__(config, max_length, span_size, filter, split, reverse, trim, **kwargs)
@@ -0,0 +1,135 @@
+'''
+A module implementing a background prefetcher for dataloaders.
+'''
+import time
+import queue
+import threading
+
+import torch
+from torch._utils import ExceptionWrapper
+
+
+class Prefetcher(object):
+    '''
+    Wraps a dataloader and stages the next batches onto the device on a background thread, so that
+    getting and collating a batch overlaps with the model step. On CUDA the copies are issued
+    non-blocking on a side stream, which is synchronized before the batch is handed over, so the
+    source buffers can be safely reused. The consumer records its stream on the staged tensors, so
+    their memory is not reused until the model step is done with them. On the CPU the thread simply runs ahead of the training
+    loop.
+    '''
+    # Only these batch entries are moved to the device. The lengths stay on the CPU, which is where
+    # pack_padded_sequence needs them.
+    DEVICE_KEYS = ('inputs', 'targets')
+
+    def __init__(self, dataloader, device, depth=2):
+        ''' Initialize the prefetcher '''
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+        self.reset_stats()
+
+    def __getattr__(self, name):
+        ''' Any missing attributes get forwarded to the underlying dataloader '''
+        if name.startswith('__') or name == 'dataloader':
+            raise AttributeError(name)
+
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        ''' Get the number of batches of the underlying dataloader '''
+        return len(self.dataloader)
+
+    def reset_stats(self):
+        ''' Reset the queue statistics '''
+        self.stats = {'batches': 0, 'wait_time': 0., 'queue_depth': 0}
+
+    def summary(self):
+        ''' Get the mean wait time for a batch and the mean queue depth when a batch was requested '''
+        batches = max(self.stats['batches'], 1)
+        return {
+            'prefetch_wait_time': self.stats['wait_time'] / batches,
+            'prefetch_queue_depth': self.stats['queue_depth'] / batches
+        }
+
+    def to_device(self, batch, non_blocking=False):
+        ''' Move the batch to the device '''
+        if not isinstance(batch, dict):
+            return batch
+
+        return {
+            key: value.to(self.device, non_blocking=non_blocking)
+            if key in type(self).DEVICE_KEYS and torch.is_tensor(value) else value
+            for key, value in batch.items()
+        }
+
+    def record_stream(self, batch):
+        '''
+        Mark the tensors staged on the side stream as in use by the current stream, so the caching
+        allocator does not hand their memory to the next copy while the model step still reads them
+        '''
+        if self.device.type != 'cuda' or not isinstance(batch, dict):
+            return
+
+        stream = torch.cuda.current_stream(self.device)
+        for key in type(self).DEVICE_KEYS:
+            value = batch.get(key)
+            if torch.is_tensor(value) and value.is_cuda:
+                value.record_stream(stream)
+
+    def load(self, batches, stop):
+        ''' Load batches into the queue until exhausted or asked to stop '''
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+            for batch in self.dataloader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self.to_device(batch, non_blocking=True)
+                    stream.synchronize()
+                else:
+                    batch = self.to_device(batch)
+
+                if not put(batch):
+                    return
+        except Exception:  # pylint:disable=broad-except
+            put(ExceptionWrapper(where='in prefetcher thread'))
+            return
+
+        put(StopIteration())
+
+    def __iter__(self):
+        ''' Iterate over the prefetched batches '''
+        stop = threading.Event()
+        batches = queue.Queue(maxsize=self.depth)
+        thread = threading.Thread(target=self.load, args=(batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                self.stats['queue_depth'] += batches.qsize()
+
+                start = time.time()
+                batch = batches.get()
+                self.stats['wait_time'] += time.time() - start
+
+                if isinstance(batch, StopIteration):
+                    break
+
+                if isinstance(batch, ExceptionWrapper):
+                    batch.reraise()
+
+                self.record_stream(batch)
+                self.stats['batches'] += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -1,32 +1,130 @@
 '''
 A module implementing various data samplers for datasets.
 '''
+import os
+import itertools
+import collections
+
 import numpy as np
-import psutil
+from data.binary import save_array
+from data.budget import TokenBudget
 from model import NUM_DEVICES
 from torch.utils.data import Sampler
 
 
+def source_length_order(datasource):
+    '''
+    Return the example indices sorted by decreasing source length (ties keep dataset order), using
+    the precomputed length index of the dataset rather than materializing any examples.
+    '''
+    return np.argsort(-datasource.lengths[:, 0], kind='stable')
+
+
+def padded_target_lengths(target_lengths, span_size):
+    ''' Get the padded length of each target, with its start tokens, rounded up to whole spans '''
+    target_lengths = target_lengths.astype(np.int64) + span_size
+    return ((target_lengths - 1) // span_size + 1) * span_size
+
+
+def token_batches(examples, max_tokens, bsz_mult=NUM_DEVICES):
+    '''
+    Lazily group an iterable of (index, length) into lists of indices, where each batch is as large
+    as possible while the number of examples times the longest length is within max_tokens. Batches
+    are kept a multiple of bsz_mult where possible, carrying the remainder into the next batch. The
+    longest length is tracked with a monotonic queue, so the work per example is amortized O(1),
+    and only the current batch is held in memory.
+    '''
+    batch = []
+    start = 0
+    # The (position, length) of the examples which may yet be the longest, in decreasing length
+    longest = collections.deque()
+    for position, (idx, length) in enumerate(examples):
+        while longest and longest[-1][1] <= length:
+            longest.pop()
+        longest.append((position, length))
+
+        if batch and (len(batch) + 1) * longest[0][1] > max_tokens:
+            batch_len = max(bsz_mult * (len(batch) // bsz_mult), len(batch) % bsz_mult)
+            yield batch[:batch_len]
+
+            batch = batch[batch_len:]
+            start += batch_len
+            while longest[0][0] < start:
+                longest.popleft()
+
+        batch.append(idx)
+
+    if batch:
+        yield batch
+
+
+def batch_plan(plan_path, num_examples, make_batches):
+    '''
+    Load the batch plan saved at plan_path, as flat example indices and offsets of each batch into
+    them, if it is valid for a dataset with num_examples examples. Otherwise call make_batches and
+    save the plan, so samplers do not need to recompute their batches every time they are created.
+    '''
+    if plan_path is None:
+        return make_batches()
+
+    indices_path = f'{plan_path}.indices.npy'
+    offsets_path = f'{plan_path}.offsets.npy'
+    if os.path.exists(indices_path) and os.path.exists(offsets_path):
+        indices = np.load(indices_path)
+        offsets = np.load(offsets_path)
+        if (
+                len(offsets) and offsets[0] == 0 and offsets[-1] == len(indices) and
+                np.all(np.diff(offsets) > 0) and
+                (not len(indices) or (indices.min() >= 0 and indices.max() < num_examples))
+        ):
+            print("Loaded batch plan from %s" % plan_path)
+            return np.split(indices, offsets[1:-1]) if len(indices) else []
+
+        print("Ignoring invalid batch plan %s" % plan_path)
+
+    batches = make_batches()
+    dtype = np.int32 if num_examples <= np.iinfo(np.int32).max else np.int64
+    save_array(indices_path, np.concatenate(batches).astype(dtype) if batches else np.zeros(0, dtype=dtype))
+    save_array(offsets_path, np.cumsum([0] + [len(b) for b in batches], dtype=np.int64))
+    print("Saved batch plan to %s" % plan_path)
+
+    return batches
+
+
+def batch_costs(datasource, batches):
+    ''' Get the number of tokens in the padded tensors of each batch '''
+    source_lengths = datasource.lengths[:, 0].astype(np.int64)
+    target_widths = padded_target_lengths(datasource.lengths[:, 1], datasource.span_size)
+    return np.array([
+        len(b) * (source_lengths[b].max() + target_widths[b].max()) if len(b) else 0
+        for b in batches
+    ], dtype=np.int64)
+
+
 class RandomBatchSampler(Sampler):
     ''' A sampler that tries to select batches that have a given total sequence length '''
-    def __init__(self, datasource, batch_size, drop_last=False, shuffle=False):
+    def __init__(self, datasource, batch_size, drop_last=False, shuffle=False, plan_path=None):
         super(RandomBatchSampler, self).__init__(datasource)
 
-        self.batches = []
         self.shuffle = shuffle
+        self.batches = batch_plan(
+            plan_path, len(datasource),
+            lambda: self.make_batches(datasource, batch_size, drop_last)
+        )
 
-        data_indices = [i[0] for i in sorted(enumerate(datasource), key=lambda x: len(x[1]), reverse=True)]
+    @staticmethod
+    def make_batches(datasource, batch_size, drop_last):
+        ''' Make the batches '''
+        batches = []
+        data_indices = source_length_order(datasource)
 
-        batch = []
+        for i in range(0, len(data_indices), batch_size):
+            batches.append(data_indices[i:i + batch_size])
 
-        for idx in data_indices:
-            batch.append(idx)
-            if len(batch) == batch_size:
-                self.batches.append(batch)
-                batch = []
+        if drop_last and batches and len(batches[-1]) < batch_size:
+            batches = batches[:-1]
 
-        if not drop_last and len(batch) > 0:
-            self.batches.append(batch)
+        return batches
 
     def __len__(self):
         ''' Estimate the number of batches per iteration '''
@@ -39,7 +137,7 @@ class RandomBatchSampler(Sampler):
             np.random.shuffle(batch_indices)
 
         for idx in batch_indices:
-            yield self.batches[idx]
+            yield self.batches[idx].tolist()
 
 
 class SequenceLengthSampler3(Sampler):
@@ -53,7 +151,8 @@ class SequenceLengthSampler3(Sampler):
         # print("datasource[0]", datasource[0])
         # print("shuffle", shuffle)
 
-        data_indices = [i[0] for i in sorted(enumerate(datasource), key=lambda x: len(x[1][0]), reverse=True)]
+        source_lengths = datasource.lengths[:, 0]
+        data_indices = source_length_order(datasource)
         # print("data_indices", data_indices)
         # print("data_indices[0]", data_indices[0])
         # print("datasource[data_indices[0]][0]", len(datasource[data_indices[0]][1]))
@@ -64,9 +163,9 @@ class SequenceLengthSampler3(Sampler):
 
         batch = []
 
-        for idx in data_indices:
+        for idx in data_indices.tolist():
             if len(batch) == 0:
-                seq_len = len(datasource[data_indices[idx]][1])
+                seq_len = source_lengths[idx]
                 # print("batch_size", batch_size)
                 # print("seq_len", seq_len)
                 batch_max_len = batch_size // seq_len
@@ -80,9 +179,8 @@ class SequenceLengthSampler3(Sampler):
                 # print("batch len", len(batch))
                 # print("batch", batch)
                 if shuffle:
-                    self.batches.append(np.random.shuffle(batch))
-                else:
-                    self.batches.append(batch)
+                    np.random.shuffle(batch)
+                self.batches.append(batch)
                 batch = []
 
         if not drop_last and len(batch) > 0:
@@ -101,36 +199,44 @@ class SequenceLengthSampler3(Sampler):
             np.random.shuffle(batch_indices)
 
         for idx in batch_indices:
-            print("idx", idx)
-            print("batches[idx]", self.batches[idx])
             yield self.batches[idx]
 
 
 class SequenceLengthSampler(Sampler):
     ''' A sampler that tries to select batches that have a given total sequence length '''
-    def __init__(self, datasource, batch_size, drop_last=False, shuffle=False):
+    def __init__(self, datasource, batch_size, drop_last=False, shuffle=False, plan_path=None):
         super(SequenceLengthSampler, self).__init__(datasource)
 
-        self.batches = []
         self.shuffle = shuffle
+        self.batches = batch_plan(
+            plan_path, len(datasource),
+            lambda: self.make_batches(datasource, batch_size, drop_last)
+        )
+        print("num batches", len(self.batches))
 
-        data_indices = [i[0] for i in sorted(enumerate(datasource), key=lambda x: len(x[1][1]), reverse=True)]
+    @staticmethod
+    def make_batches(datasource, batch_size, drop_last):
+        ''' Make the batches '''
+        batches = []
+        source_lengths = datasource.lengths[:, 0]
+        data_indices = source_length_order(datasource)
 
         i = 0
 
         batch_max_len = 0
 
         while i < len(data_indices):
-            seq_len = len(datasource[data_indices[i]][1])
+            seq_len = source_lengths[data_indices[i]]
             batch_max_len = batch_size // seq_len
             batch_max_len -= batch_max_len % NUM_DEVICES
             batch_max_len = max(batch_max_len, 1)
-            self.batches.append(data_indices[i:i + batch_max_len])
+            batches.append(data_indices[i:i + batch_max_len])
             i += batch_max_len
 
-        if drop_last and len(self.batches[-1]) < batch_max_len:
-            self.batches = self.batches[:-1]
-        print("num batches", len(self.batches))
+        if drop_last and batches and len(batches[-1]) < batch_max_len:
+            batches = batches[:-1]
+
+        return batches
 
     def __len__(self):
         ''' Estimate the number of batches per iteration '''
@@ -143,66 +249,402 @@ class SequenceLengthSampler(Sampler):
             np.random.shuffle(batch_indices)
 
         for idx in batch_indices:
-            yield self.batches[idx]
+            yield self.batches[idx].tolist()
+
+
+class PaddedTokenSampler(Sampler):
+    '''
+    A sampler that fills batches up to a token budget, where the cost of a batch is the footprint of
+    its padded tensors: the longest source plus the longest target (with its start tokens, rounded up
+    to whole spans as in data.collate.Collator) times the number of examples. Examples are ordered
+    by source then target length, so each batch groups similar lengths and wastes little on padding.
+    '''
+    def __init__(self, datasource, batch_size, drop_last=False, shuffle=False, plan_path=None):
+        super(PaddedTokenSampler, self).__init__(datasource)
+
+        self.shuffle = shuffle
+        self.padding_ratio = 0.
+        self.batches = batch_plan(
+            plan_path, len(datasource),
+            lambda: self.make_batches(datasource, batch_size, drop_last)
+        )
+
+        # The number of real and padded tokens of each batch
+        source_lengths = datasource.lengths[:, 0].astype(np.int64)
+        target_lengths = datasource.lengths[:, 1].astype(np.int64) + datasource.span_size
+        self.tokens = np.array([
+            source_lengths[b].sum() + target_lengths[b].sum() for b in self.batches
+        ], dtype=np.int64)
+        self.padded_tokens = batch_costs(datasource, self.batches)
+        print("num batches", len(self.batches))
+
+    @staticmethod
+    def make_batches(datasource, batch_size, drop_last):
+        ''' Make the batches '''
+        batches = []
+        source_lengths = datasource.lengths[:, 0].astype(np.int64)
+        target_widths = padded_target_lengths(datasource.lengths[:, 1], datasource.span_size)
+        data_indices = np.lexsort((-target_widths, -source_lengths))
+
+        batch = []
+        max_target_width = 0
+        for idx in data_indices.tolist():
+            target_width = max(max_target_width, target_widths[idx])
+            source_width = source_lengths[batch[0]] if batch else source_lengths[idx]
+            if batch and (len(batch) + 1) * (source_width + target_width) > batch_size:
+                # Keep the batch a multiple of the number of devices, carrying over the remainder
+                batch_len = max(NUM_DEVICES * (len(batch) // NUM_DEVICES), len(batch) % NUM_DEVICES)
+                batches.append(np.array(batch[:batch_len]))
+                batch = batch[batch_len:]
+                max_target_width = max((target_widths[i] for i in batch), default=0)
+                target_width = max(max_target_width, target_widths[idx])
+
+            batch.append(idx)
+            max_target_width = target_width
+
+        if batch and not drop_last:
+            batches.append(np.array(batch))
+
+        return batches
+
+    def __len__(self):
+        ''' Estimate the number of batches per iteration '''
+        return len(self.batches)
+
+    def __iter__(self):
+        ''' Iterate over the batches, reporting the fraction of padding at the end of the epoch '''
+        batch_indices = np.arange(len(self))
+        if self.shuffle:
+            np.random.shuffle(batch_indices)
+
+        tokens = 0
+        padded_tokens = 0
+        for idx in batch_indices:
+            tokens += self.tokens[idx]
+            padded_tokens += self.padded_tokens[idx]
+            yield self.batches[idx].tolist()
+
+        self.padding_ratio = 1 - tokens / max(padded_tokens, 1)
+        print("padding ratio", self.padding_ratio)
+
+
+class DistributedBatchSampler(Sampler):
+    '''
+    A sampler that deterministically shards the batches of another batch sampler across world_size
+    processes. The order only depends on the seed and the epoch, never on the global random state.
+
+    Batches are grouped world_size at a time by their padded token cost, so each step every rank
+    gets a batch of similar cost. Within a group the costliest batch goes to the rank with the least
+    load so far, which keeps the total token load of the ranks equal. Every rank gets the same number
+    of batches; the last group is completed with batches from the start if needed.
+
+    The batches are re-read from the batch sampler every epoch, so a sampler which rebatches each
+    time it is iterated still does. Resuming mid-epoch, load a state whose position is the number of
+    batches the training loop already consumed, so the next iteration skips exactly those. The
+    sampler cannot know this itself, as batches are handed out ahead of their use to the dataloader
+    workers and any prefetcher.
+
+    When each process only loads its own shard of the corpus, the batch sampler is already over the
+    shard, so pass a world_size of 1 and the num_batches every process should take, such that all
+    processes still take the same number of steps.
+    '''
+    def __init__(self, datasource, batch_sampler, rank=0, world_size=1, seed=0, shuffle=True, num_batches=None):
+        super(DistributedBatchSampler, self).__init__(datasource)
+
+        if not 0 <= rank < world_size:
+            raise ValueError(f'Invalid rank {rank} for a world size of {world_size}!')
+
+        self.rank = rank
+        self.seed = seed
+        self.shuffle = shuffle
+        self.world_size = world_size
+        self.num_batches = num_batches
+
+        self.datasource = datasource
+        self.batch_sampler = batch_sampler
+        self.padding_ratio = 0.
+
+        self.epoch = 0
+        self.position = 0
+        self.load_batches()
+
+    def __getattr__(self, name):
+        ''' Any missing attributes get forwarded to the underlying batch sampler '''
+        if name.startswith('__') or name == 'batch_sampler':
+            raise AttributeError(name)
+
+        return getattr(self.batch_sampler, name)
+
+    def load_batches(self):
+        ''' Read the batches of the underlying batch sampler '''
+        batches = getattr(self.batch_sampler, 'batches', None)
+        if batches is None:
+            batches = list(self.batch_sampler)
+        self.batches = [np.asarray(batch) for batch in batches]
+
+        self.costs = batch_costs(self.datasource, self.batches)
+
+    def __len__(self):
+        ''' Get the number of batches of this rank per iteration '''
+        if self.num_batches is not None:
+            return self.num_batches
+
+        return -(-len(self.batches) // self.world_size)
+
+    def set_epoch(self, epoch):
+        ''' Set the epoch, which determines the order of the batches, and start it from the beginning '''
+        self.epoch = epoch
+        self.position = 0
+        self.load_batches()
+
+    def state_dict(self, position=0):
+        ''' Get the state of the sampler, resuming the epoch after the given number of consumed batches '''
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': position}
+
+    def load_state_dict(self, state):
+        ''' Load the state of the sampler '''
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.position = state['position']
+
+    def rank_batches(self):
+        ''' Get the indices of the batches of this rank for the current epoch, in order '''
+        random = np.random.RandomState([self.seed, self.epoch])
+
+        # Complete the last group by cycling back to the start. A single rank has nothing to
+        # balance, so it keeps the order of the batch sampler.
+        if self.world_size > 1:
+            order = np.argsort(self.costs, kind='stable')
+        else:
+            order = np.arange(len(self.costs))
+        groups = np.resize(order, len(self) * self.world_size).reshape(-1, self.world_size)
+        if self.shuffle:
+            groups = groups[random.permutation(len(groups))]
+
+        loads = np.zeros(self.world_size, dtype=np.int64)
+        rank_batches = []
+        for group in groups:
+            group = group[np.argsort(-self.costs[group], kind='stable')]
+            ranks = np.argsort(loads, kind='stable')
+            loads[ranks] += self.costs[group]
+            rank_batches.append(group[np.flatnonzero(ranks == self.rank)[0]])
+
+        return rank_batches
+
+    def __iter__(self):
+        '''
+        Iterate over the batches of this rank, skipping the first position batches if resuming. The
+        fraction of padding is reported at the end of the epoch, if the batch sampler counts tokens.
+        '''
+        rank_batches = self.rank_batches()
+        start, self.position = self.position, 0
+
+        tokens = getattr(self.batch_sampler, 'tokens', None)
+        real_tokens = 0
+        padded_tokens = 0
+        for idx in rank_batches[start:]:
+            if tokens is not None:
+                real_tokens += tokens[idx]
+                padded_tokens += self.costs[idx]
+            yield self.batches[idx].tolist()
+
+        if tokens is not None:
+            self.padding_ratio = 1 - real_tokens / max(padded_tokens, 1)
+            print("padding ratio", self.padding_ratio)
+
+
+class AdaptiveBatchSampler(Sampler):
+    '''
+    A sampler that splits the batches of another batch sampler so that each fits within an adaptive
+    token budget (see data.budget.TokenBudget). The budget starts out at the cost of the costliest
+    batch, so batches are only split once the budget has been shrunk. Since the number of batches
+    depends on the budget, the sampler has no length.
+    '''
+    def __init__(self, datasource, batch_sampler, high_water=0.9, host_memory_limit=None):
+        super(AdaptiveBatchSampler, self).__init__(datasource)
+
+        self.datasource = datasource
+        self.batch_sampler = batch_sampler
+
+        batches = getattr(batch_sampler, 'batches', None)
+        if batches is None:
+            batches = list(batch_sampler)
+        self.budget = TokenBudget(
+            int(max(batch_costs(datasource, batches), default=1)), high_water,
+            host_memory_limit=host_memory_limit
+        )
+
+    def __getattr__(self, name):
+        ''' Any missing attributes get forwarded to the underlying batch sampler '''
+        if name.startswith('__') or name == 'batch_sampler':
+            raise AttributeError(name)
+
+        return getattr(self.batch_sampler, name)
+
+    def __iter__(self):
+        ''' Iterate over the batches, split to fit the current budget '''
+        source_lengths = self.datasource.lengths[:, 0]
+        target_widths = padded_target_lengths(self.datasource.lengths[:, 1], self.datasource.span_size)
+        for batch in self.batch_sampler:
+            chunk = []
+            max_source = max_target = 0
+            for idx in batch:
+                source = max(max_source, source_lengths[idx])
+                target = max(max_target, target_widths[idx])
+                if chunk and (len(chunk) + 1) * (source + target) > self.budget.tokens:
+                    yield chunk
+                    chunk = []
+                    source, target = source_lengths[idx], target_widths[idx]
+
+                chunk.append(idx)
+                max_source, max_target = source, target
+
+            if chunk:
+                yield chunk
+
+
+def balanced_chunks(source_lengths, target_widths, num_chunks):
+    '''
+    Partition a batch, given the source lengths and padded target widths of its examples in order,
+    into at most num_chunks contiguous chunks, such that the largest padded token cost of a chunk is
+    as small as possible. Returns the size of each chunk.
+    '''
+    def partition(max_cost):
+        ''' Greedily partition the batch into chunks which each cost at most max_cost '''
+        sizes = []
+        start = max_source = max_target = 0
+        for end, (source, target) in enumerate(zip(source_lengths, target_widths)):
+            source = max(max_source, source)
+            target = max(max_target, target)
+            if end > start and (end - start + 1) * (source + target) > max_cost:
+                sizes.append(end - start)
+                start = end
+                source, target = source_lengths[end], target_widths[end]
+
+            max_source, max_target = source, target
+
+        if start < len(source_lengths):
+            sizes.append(len(source_lengths) - start)
+
+        return sizes
+
+    # Binary search for the smallest max cost which needs no more than num_chunks chunks
+    low = int(max((s + t for s, t in zip(source_lengths, target_widths)), default=0))
+    high = len(source_lengths) * (int(max(source_lengths, default=0)) + int(max(target_widths, default=0)))
+    while low < high:
+        mid = (low + high) // 2
+        if len(partition(mid)) <= num_chunks:
+            high = mid
+        else:
+            low = mid + 1
+
+    sizes = partition(low)
+    while len(sizes) < num_chunks and max(sizes, default=0) > 1:
+        # Splitting a chunk never increases the max cost, so use as many chunks as allowed
+        idx = sizes.index(max(sizes))
+        sizes[idx:idx + 1] = [sizes[idx] - sizes[idx] // 2, sizes[idx] // 2]
+
+    return sizes
+
+
+class DeviceBatchSampler(Sampler):
+    '''
+    A sampler that splits each batch of another batch sampler into one sub-batch per device, as
+    contiguous runs of the examples ordered by decreasing source length, such that the costliest
+    sub-batch (by padded token cost) is as cheap as possible. The collator records the sizes of the
+    sub-batches as the chunk_sizes of the batch, which model.utils.ChunkedDataParallel scatters by,
+    so no replica idles waiting on a much costlier one.
+    '''
+    def __init__(self, datasource, batch_sampler, num_devices=NUM_DEVICES):
+        super(DeviceBatchSampler, self).__init__(datasource)
+
+        self.num_devices = num_devices
+        self.batch_sampler = batch_sampler
+        self.source_lengths = datasource.lengths[:, 0].astype(np.int64)
+        self.target_widths = padded_target_lengths(datasource.lengths[:, 1], datasource.span_size)
+
+    def __getattr__(self, name):
+        ''' Any missing attributes get forwarded to the underlying batch sampler '''
+        if name.startswith('__') or name == 'batch_sampler':
+            raise AttributeError(name)
+
+        return getattr(self.batch_sampler, name)
+
+    def __len__(self):
+        ''' Get the number of batches per iteration '''
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        ''' Iterate over the batches, each a list of per device sub-batches '''
+        for batch in self.batch_sampler:
+            batch = np.asarray(batch)
+            batch = batch[np.argsort(-self.source_lengths[batch], kind='stable')]
+            sizes = balanced_chunks(self.source_lengths[batch], self.target_widths[batch], self.num_devices)
+            yield [chunk.tolist() for chunk in np.split(batch, np.cumsum(sizes)[:-1])]
 
 
 class SequenceLengthSampler2(Sampler):
-    ''' A sampler that tries to select batches that have a given total sequence length '''
+    '''
+    A sampler that lazily groups the examples, ordered by decreasing target length, into batches
+    whose padded size stays within a token budget (see token_batches). Only the current batch is
+    held in memory, and the number of batches is computed exactly up front.
+    '''
     def __init__(self, example_lengths, batch_size, drop_last=False, shuffle=False):
         super(SequenceLengthSampler2, self).__init__(example_lengths)
 
-        self.batches = []
         self.shuffle = shuffle
         self.batch_size = batch_size
-        self.example_lengths = example_lengths
         self.drop_last = drop_last
-        self.indices = [i[0] for i in sorted(enumerate(example_lengths), key=lambda x: x[1][1], reverse=True)]
-
+        self.target_lengths = np.asarray(example_lengths)[:, 1]
 
+        # The batches only depend on the sequence of lengths, which shuffling ties does not change
+        num_batches = sum(1 for _ in token_batches(self.examples(), self.batch_size))
+        self.num_batches = num_batches - 1 if drop_last and num_batches else num_batches
 
     def __len__(self):
-        ''' Estimate the number of batches per iteration '''
-        return len(self.batches)
+        ''' Get the number of batches per iteration '''
+        return self.num_batches
+
+    def examples(self):
+        ''' Lazily yield the (index, length) of each example, ordered by decreasing target length '''
+        keys = (-self.target_lengths,)
+        if self.shuffle:
+            # Break ties randomly
+            keys = (np.random.permutation(len(self.target_lengths)),) + keys
+
+        indices = np.lexsort(keys)
+        return zip(indices.tolist(), self.target_lengths[indices].tolist())
 
     def __iter__(self):
         ''' Iterate over the batches '''
-        vm = psutil.virtual_memory()
-        print("1virtual_memory", vm)
-        max_tokens = self.batch_size
-        max_sentences = float("Inf")
-        bsz_mult = NUM_DEVICES
+        return itertools.islice(token_batches(self.examples(), self.batch_size), self.num_batches)
 
-        batch = []
 
-        def is_batch_full(num_tokens):
-            if len(batch) == 0:
-                return False
-            if len(batch) == max_sentences:
-                return True
-            if num_tokens > max_tokens:
-                return True
-            return False
-
-        sample_len = 0
-        sample_lens = []
-        for idx in self.indices:
-            sample_lens.append(self.example_lengths[idx][1])
-            sample_len = max(sample_len, sample_lens[-1])
-            assert sample_len <= max_tokens, "sentence at index {idx} exceeds max_tokens limit!".format(idx=idx)
-            num_tokens = (len(batch) + 1) * sample_len
-            if is_batch_full(num_tokens):
-                mod_len = max(
-                    bsz_mult * (len(batch) // bsz_mult),
-                    len(batch) % bsz_mult,
-                )
-                vm = psutil.virtual_memory()
-                print("2virtual_memory", vm)
-                yield batch[:mod_len]
-                batch = batch[mod_len:]
-                sample_lens = sample_lens[mod_len:]
-                sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
+class DecodeBatchSampler(Sampler):
+    '''
+    A sampler for decoding. Each window of consecutive examples is sorted by decreasing source
+    length, then packed into batches where the batch size times beam_width times the longest source
+    plus the decoded length is within max_tokens, as every hypothesis of the beam attends over its
+    source for each of the decode_length steps. Since the batches of a window are done before the
+    next window starts, restoring the original order never needs to hold back more than a window of
+    outputs. A window of 0 sorts the whole split.
+    '''
+    def __init__(self, datasource, max_tokens, beam_width=1, decode_length=0, window=0):
+        super(DecodeBatchSampler, self).__init__(datasource)
 
-            batch.append(idx)
+        source_lengths = datasource.lengths[:, 0].astype(np.int64)
+        costs = beam_width * (source_lengths + decode_length)
+
+        window = window or len(source_lengths)
+        self.batches = []
+        for start in range(0, len(source_lengths), window):
+            order = start + np.argsort(-source_lengths[start:start + window], kind='stable')
+            self.batches.extend(token_batches(zip(order.tolist(), costs[order].tolist()), max_tokens))
 
-        if len(batch) > 0 and not self.drop_last:
-            yield batch
\ No newline at end of file
+    def __len__(self):
+        ''' Get the number of batches '''
+        return len(self.batches)
+
+    def __iter__(self):
+        ''' Iterate over the batches '''
+        return iter(self.batches)
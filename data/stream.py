@@ -0,0 +1,127 @@
+'''
+A module implementing a streaming dataset for corpora which do not fit in memory.
+'''
+import random
+import itertools
+
+from data.sampler2 import token_batches
+from model import NUM_DEVICES
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class StreamingTextDataset(IterableDataset):
+    '''
+    Wraps a TextDataset created with streaming=True. Pairs are read line by line, passed through a
+    bounded shuffle buffer, filtered and trimmed on the fly, then sorted within a local window and
+    grouped into batches within the token budget by data.sampler2.token_batches. Memory
+    is bounded by the buffer and window sizes rather than the size of the corpus.
+
+    Example ids are line numbers, unless contiguous_ids is set, in which case they number the
+    examples which pass the filter, as the indices of a dataset which is not streamed do. Each
+    worker then reads and filters every line, so only use it where the ids matter, e.g. decoding.
+    '''
+    def __init__(self, dataset, batch_size, buffer_size=100000, window_size=10000, shuffle=False,
+                 drop_last=False, contiguous_ids=False):
+        super(StreamingTextDataset, self).__init__()
+
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.contiguous_ids = contiguous_ids
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.window_size = window_size
+
+    def __getattr__(self, name):
+        ''' Any missing attributes get forwarded to the underlying text dataset '''
+        if name.startswith('__') or name == 'dataset':
+            raise AttributeError(name)
+
+        return getattr(self.dataset, name)
+
+    def filtered(self, lines):
+        ''' Lazily yield the (line number, pair) of each line which passes the filter '''
+        for line_number, line_pair in lines:
+            pair = self.dataset.make_pair(line_pair)
+            if self.dataset.filter and not self.dataset.filter_pair(pair):
+                continue
+
+            yield line_number, pair
+
+    def pairs(self):
+        ''' Lazily yield the (example id, prepared pair) of each example in this worker's shard '''
+        worker_info = get_worker_info()
+        if self.contiguous_ids:
+            pairs = enumerate(pair for _, pair in self.filtered(enumerate(self.dataset.read_lines())))
+            if worker_info is not None:
+                pairs = itertools.islice(pairs, worker_info.id, None, worker_info.num_workers)
+        else:
+            lines = enumerate(self.dataset.read_lines())
+            if worker_info is not None:
+                lines = itertools.islice(lines, worker_info.id, None, worker_info.num_workers)
+            pairs = self.filtered(lines)
+
+        for example_id, pair in pairs:
+            if self.dataset.trim:
+                pair = self.dataset.trim_pair(pair)
+
+            yield example_id, pair
+
+    def shuffled(self, examples):
+        ''' Shuffle the examples using a bounded buffer '''
+        if not self.shuffle:
+            yield from examples
+            return
+
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(example)
+                continue
+
+            idx = random.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = example
+
+        random.shuffle(buffer)
+        yield from buffer
+
+    def batch_limit(self, seq_len):
+        ''' The number of examples of the given source length which fit in a batch '''
+        batch_max_len = self.batch_size // seq_len
+        batch_max_len -= batch_max_len % NUM_DEVICES
+        return max(batch_max_len, 1)
+
+    def batches(self, window):
+        ''' Group a window of examples into batches, ordered from longest to shortest source '''
+        window.sort(key=lambda x: len(x[1]), reverse=True)
+
+        examples = ((i, len(example[1])) for i, example in enumerate(window))
+        return [[window[i] for i in batch] for batch in token_batches(examples, self.batch_size)]
+
+    def __iter__(self):
+        ''' Iterate over the batches of examples '''
+        examples = (
+            (example_id,) + tuple(self.dataset.ids_from_pair(pair))
+            for example_id, pair in self.pairs()
+        )
+
+        window = []
+        for example in self.shuffled(examples):
+            window.append(example)
+            if len(window) >= self.window_size:
+                batches = self.batches(window)
+
+                # Carry the last (possibly partial) batch over into the next window
+                window = batches.pop() if len(batches) > 1 else []
+                if self.shuffle:
+                    random.shuffle(batches)
+                yield from batches
+
+        batches = self.batches(window)
+        if batches and self.drop_last and len(batches[-1]) < self.batch_limit(len(batches[-1][0][1])):
+            batches = batches[:-1]
+
+        if self.shuffle:
+            random.shuffle(batches)
+        yield from batches
@@ -1,29 +1,70 @@
+import os
+import sys
+import atexit
+import pickle
+import json
 import torch
-import collections
+import hashlib
+import collections.abc
 import itertools
+import numpy as np
 from torch import nn
 from torch.utils.data import Dataset
+from multiprocessing import Pool
 
 import tarfile
 import torch
 import torch.utils.data as Data
 from model import EOS_token, DEVICE, UNK_token
+import utils.file as file_utils
+from data.binary import BinaryCorpus, save_array, shard_bounds
+from data.collate import Collator
+from data.vocab import Vocabulary, PAD, SOS, EOS, UNK
+from utils import tqdm_wrap_stdout
+from tqdm import tqdm
 
-PAD = '<PAD>'
-# ALIGN = '<ALIGN>'
-SOS = '<SOS>'
-EOS = '<EOS>'
-UNK = '<UNK>'
+# The pool shared by the binarization of every split, started on first use
+_POOL = None
+_POOL_WORKERS = 0
+
+# The datasets unpickled by a pool worker, keyed by their binary path
+_DATASETS = {}
+
+
+def get_binarize_pool(workers):
+    ''' Get the pool shared across splits, starting it on first use '''
+    global _POOL, _POOL_WORKERS  # pylint:disable=global-statement
+    if _POOL is None:
+        _POOL = Pool(workers)
+        _POOL_WORKERS = workers
+        atexit.register(_POOL.terminate)
+
+    return _POOL, _POOL_WORKERS
+
+
+def _binarize(key, dataset, lines):
+    ''' Binarize a chunk of line pairs in a pool worker, unpickling each dataset only once '''
+    if key not in _DATASETS:
+        _DATASETS.clear()
+        _DATASETS[key] = pickle.loads(dataset)
+
+    return _DATASETS[key].binarize_lines(lines)
 
 
 class TextDataset(Dataset):
     """
     Prepare data from WMTDataset
     """
-    def __init__(self, max_length, span_size, filter, split="train", reverse=False, trim=False):
-        self.word2index = {PAD: 0, SOS: 1, EOS: 2, UNK: 3}
-        # self.word2count = {}
-        self.index2word = [PAD, SOS, EOS, UNK]
+    # Bump whenever the format of the binarized splits changes
+    BINARY_VERSION = 2
+
+    def __init__(self, max_length, span_size, filter, split="train", reverse=False, trim=False, binarized=False,
+                 streaming=False, cached=False, vocab=None, preprocess_workers=1, preprocess_buffer_size=12500,
+                 shard=None):
+        # Pass in the vocab of another split to share it rather than reading it again
+        self.vocab = vocab
+        # An optional (index, num_shards) of the shard of the corpus to load
+        self.shard = shard
         self.split = split
         self.filter = filter
 
@@ -31,144 +72,346 @@ class TextDataset(Dataset):
         self.reverse = reverse
         self.max_length = max_length
         self.trim = trim
+        self.binarized = binarized
+        self.streaming = streaming
+        self.cached = cached
+        self.preprocess_workers = preprocess_workers
+        self.preprocess_buffer_size = preprocess_buffer_size
 
         self.pairs = []
+        self.corpus = None
+        self.lengths = None
+        self.global_lengths = None
+        self.shard_range = None
+        self._cache_key = None
         self.prepare_data()
 
     def __len__(self):
         ''' Get the length of the dataset '''
+        if self.corpus is not None:
+            return len(self.corpus)
         return len(self.pairs)
 
     def __getitem__(self, index):
         ''' Get the story/stories at the specified index/indices '''
-        if isinstance(index, collections.Sequence):
+        if isinstance(index, collections.abc.Sequence):
             return tuple(
-                tuple([i]) + tuple(self.tensors_from_pair(self.pairs[i])) for i in index
+                tuple([i]) + tuple(self.example(i)) for i in index
                 # tuple([i]) + tuple(torch.LongTensor(s) for s in self.pairs[i]) for i in index
             )
         else:
-            return tuple([index]) + tuple(self.tensors_from_pair(self.pairs[index]))
+            return tuple([index]) + tuple(self.example(index))
+
+    def example(self, index):
+        ''' Get the (source ids, target ids) arrays of the example at the specified index '''
+        if self.corpus is not None:
+            # Zero-copy view into the memory-mapped corpus
+            return self.corpus[index]
+        return self.pairs[index]
+
+    @property
+    def word2index(self):
+        ''' Get the mapping from word to index '''
+        return self.vocab.word2index
+
+    @property
+    def index2word(self):
+        ''' Get the word at each index '''
+        return self.vocab.index2word
 
     @property
     def padding_idx(self):
         ''' Return the padding value '''
-        return self.word2index[PAD]
+        return self.vocab.padding_idx
 
     @property
     def sos_idx(self):
         ''' Return the start of summary value '''
-        return self.word2index[SOS]
+        return self.vocab.sos_idx
 
     @property
     def eos_idx(self):
         ''' Return the end of summary value '''
-        return self.word2index[EOS]
+        return self.vocab.eos_idx
 
     @property
     def unk_idx(self):
         ''' Return the end of summary value '''
-        return self.word2index[UNK]
+        return self.vocab.unk_idx
 
     @property
     def num_words(self):
-        return len(self.index2word)
+        return len(self.vocab)
+
+    @property
+    def data_files(self):
+        ''' Get the list of files (including the vocab) the split is prepared from '''
+        raise NotImplementedError('Subclasses must implement data_files!')
+
+    @property
+    def cache_key(self):
+        ''' Get a key which changes whenever the data files or the preparation of the pairs change '''
+        if self._cache_key is None:
+            config = {
+                'files': [file_utils.fingerprint(path) for path in self.data_files],
+                'split': self.split,
+                'max_length': self.max_length,
+                'span_size': self.span_size,
+                'filter': self.filter,
+                'trim': self.trim,
+                'reverse': self.reverse,
+                'version': type(self).BINARY_VERSION
+            }
+            self._cache_key = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
-    def add_word(self, word):
-        if word not in self.word2index:
-            self.word2index[word] = self.num_words
-            # self.word2count[word] = 1
-            self.index2word.append(word)
-        # else:
-            # self.word2count[word] += 1
+        return self._cache_key
+
+    @property
+    def binary_name(self):
+        ''' Get a name for the binarized split which reflects how the pairs were prepared '''
+        name = f'{self.split}.max{self.max_length}.span{self.span_size}'
+        if self.filter:
+            name += '.filter'
+        if self.trim:
+            name += '.trim'
+        return f'{name}.{self.cache_key}'
+
+    @property
+    def binary_path(self):
+        ''' Get the path prefix of the binarized split '''
+        raise NotImplementedError('Subclasses must implement binary_path!')
 
     def prepare_data(self):
-        self.read_langs()
-        print("Counting words from vocab file...")
-        self.read_vocab()
+        if self.vocab is None:
+            print("Counting words from vocab file...")
+            self.vocab = Vocabulary.from_words(self.read_vocab())
         print("Counted words:", self.num_words)
+        if self.streaming:
+            # Pairs are read lazily by data.stream.StreamingTextDataset
+            return
+
+        if self.binarized or self.cached:
+            self.prepare_binary()
+        else:
+            self.read_langs()
+        self.prepare_lengths()
+
+        if self.shard is not None:
+            self.prepare_shard()
+
+    def prepare_binary(self):
+        '''
+        Binarize the split once. The binary path is keyed by the data files and the way the pairs are
+        prepared, so it doubles as a dataset cache. Subsequent loads either memory-map it (when
+        binarized) or read it into memory in one bulk read, instead of redoing the preprocessing.
+        '''
+        corpus = BinaryCorpus(self.binary_path)
+        if not corpus.exists():
+            print("Binarizing to %s..." % self.binary_path)
+            corpus = BinaryCorpus.merge(self.binary_path, self.binarize_chunks())
+
+        # A sharded corpus is only mapped for now, as just the shard is read in later
+        mmap = self.binarized or self.shard is not None
+        self.corpus = corpus.open(mmap=mmap)
+        print("%s %s sentence pairs from %s" % (
+            "Mapped" if mmap else "Loaded", len(self.corpus), self.binary_path
+        ))
+
+    def prepare_shard(self):
+        '''
+        Only keep the shard of the corpus for this process, a contiguous range of examples with about
+        an equal share of the tokens. The ranges are computed from the global length index, so every
+        process agrees on them without reading any tokens, and each then maps or reads in only its
+        own byte range of the binarized split.
+        '''
+        if self.corpus is None:
+            raise ValueError('Sharding requires a binarized or cached dataset!')
+
+        index, num_shards = self.shard
+        start, end = shard_bounds(self.lengths, num_shards)[index:index + 2]
+
+        self.global_lengths = self.lengths
+        self.lengths = self.global_lengths[start:end]
+        self.shard_range = (start, end)
+        self.corpus = self.corpus.shard(start, end).open(mmap=self.binarized)
+        print("%s shard %d/%d with %d of %d sentence pairs" % (
+            "Mapped" if self.binarized else "Loaded", index + 1, num_shards, len(self.corpus), len(self.global_lengths)
+        ))
+
+    def shard_views(self):
+        ''' Get a view of the length index of every shard, which is all the samplers need to batch them '''
+        bounds = shard_bounds(self.global_lengths, self.shard[1])
+        return [LengthIndex(self, self.global_lengths[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+    def binarize_lines(self, lines):
+        '''
+        Make, filter and trim the pairs from a chunk of line pairs, then encode them. Returns the
+        number of line pairs, the flat source tokens, the source lengths, the flat target tokens and
+        the target lengths.
+        '''
+        pairs = [self.make_pair(line_pair) for line_pair in lines]
+        if self.filter:
+            pairs = self.filter_pairs(pairs)
+
+        if self.trim:
+            pairs = self.trim_pairs(pairs)
+
+        chunk = [len(lines)]
+        for side in range(2):
+            ids = self.vocab.encode([pair[side] for pair in pairs], eos=True)
+            chunk.append(np.concatenate(ids) if ids else np.zeros(0, dtype=self.vocab.dtype))
+            chunk.append(np.array([len(i) for i in ids], dtype=np.int64))
+
+        return tuple(chunk)
+
+    def binarize_chunks(self):
+        '''
+        Binarize the split in chunks of preprocess_buffer_size line pairs, using a pool of
+        preprocess_workers processes shared across splits. Only a bounded number of chunks are in
+        flight at once, and the results are yielded in order.
+        '''
+        lines = self.read_lines()
+        chunks = iter(lambda: list(itertools.islice(lines, self.preprocess_buffer_size)), [])
+        if self.preprocess_workers == 1:
+            results = (self.binarize_lines(chunk) for chunk in chunks)
+        else:
+            results = self.binarize_parallel(chunks)
+
+        results = tqdm(
+            results,
+            unit='chunk',
+            dynamic_ncols=True,
+            desc=f'Binarizing {self.split}',
+            file=sys.stdout # needed to make tqdm_wrap_stdout work
+        )
+        total_lines = 0
+        with tqdm_wrap_stdout():
+            for num_lines, *arrays in results:
+                total_lines += num_lines
+                yield arrays
+
+        print("Read %s sentence pairs in %s" % (total_lines, self.split))
+
+    def binarize_parallel(self, chunks):
+        '''
+        Binarize the chunks asynchronously on the shared pool, yielding the results in order. The
+        dataset is pickled once and unpickled once per worker.
+        '''
+        pool, workers = get_binarize_pool(self.preprocess_workers or os.cpu_count())
+        dataset = pickle.dumps(self)
+        results = collections.deque()
+        for chunk in chunks:
+            results.append(pool.apply_async(_binarize, [self.binary_path, dataset, chunk]))
+            if len(results) > 2 * workers:
+                yield results.popleft().get()
+
+        while results:
+            yield results.popleft().get()
+
+    @property
+    def lengths_path(self):
+        ''' Get the path of the length index of the split '''
+        return f'{self.binary_path}.lengths.npy'
+
+    def prepare_lengths(self):
+        '''
+        Load the N x 2 array of (source, target) token counts (including EOS) of each example, which
+        the samplers use instead of materializing examples. Built once and persisted next to the data.
+        '''
+        if os.path.exists(self.lengths_path):
+            lengths = np.load(self.lengths_path)
+            if len(lengths) == len(self):
+                self.lengths = lengths
+                return
+
+        if self.corpus is not None:
+            lengths = self.corpus.lengths
+        else:
+            lengths = np.array([
+                [len(ids) for ids in pair]
+                for pair in self.pairs
+            ], dtype=np.int32).reshape(-1, 2)
+
+        save_array(self.lengths_path, lengths)
+        self.lengths = lengths
 
     def read_vocab(self):
-        ''' Read in the vocabulary file '''
+        ''' Read in the list of words from the vocabulary file '''
         raise NotImplementedError('Subclasses must implement preprocess!')
 
+    def read_lines(self):
+        ''' Lazily yield the (first language, second language) line pairs of the split '''
+        raise NotImplementedError('Subclasses must implement read_lines!')
+
+    def make_pair(self, lines):
+        '''
+        Make a (source, target) pair from a (first language, second language) pair of lines. The
+        span_size start tokens the decoder is first fed are not stored, data.collate.Collator
+        prepends them to the targets.
+        '''
+        source, target = reversed(lines) if self.reverse else lines
+        return [source, target]
+
     def read_langs(self):
         ''' Read the texts of two languages '''
-        raise NotImplementedError('Subclasses must implement preprocess!')
+        print("Reading lines...")
+        pairs = [self.make_pair(lines) for lines in self.read_lines()]
+
+        print("Read %s sentence pairs in %s" % (len(pairs), self.split))
+
+        if self.filter:
+            pairs = self.filter_pairs(pairs)
+
+        if self.trim:
+            print("Trimmed to max_length")
+            pairs = self.trim_pairs(pairs)
+
+        print("Trimmed to %s sentence pairs" % len(pairs))
+
+        # Keep the pairs as compact arrays of token ids rather than strings
+        self.pairs = list(zip(
+            self.vocab.encode([pair[0] for pair in pairs], eos=True),
+            self.vocab.encode([pair[1] for pair in pairs], eos=True)
+        ))
 
     def filter_pair(self, p):
+        # The max length of the target includes its start tokens
         return len(p[0].split(' ')) < self.max_length and \
-               len(p[1].split(' ')) < self.max_length
+               len(p[1].split(' ')) + self.span_size < self.max_length
 
     def filter_pairs(self, pairs):
         return [pair for pair in pairs if self.filter_pair(pair)]
 
-    def trim_pairs(self, pairs):
-        return [[' '.join(pair[0].split(' ')[:self.max_length - 1]), ' '.join(pair[1].split(' ')[:self.max_length - 1])] for pair in pairs]
-
-    def indexes_from_sentence(self, sentence):
-        return [self.word2index[word] if word in self.word2index else UNK_token
-                for word in sentence.split(' ')]
+    def trim_pair(self, pair):
+        source, target = pair
+        return [
+            ' '.join(source.split(' ')[:self.max_length - 1]),
+            ' '.join(target.split(' ')[:max(self.max_length - 1 - self.span_size, 0)])
+        ]
 
-    def tensor_from_sentence(self, sentence):
-        indexes = self.indexes_from_sentence(sentence)
-        indexes.append(EOS_token)
-        return torch.tensor(indexes, dtype=torch.long) #.view(-1, 1)
+    def trim_pairs(self, pairs):
+        return [self.trim_pair(pair) for pair in pairs]
 
-    def tensors_from_pair(self, pair):
-        input_tensor = self.tensor_from_sentence(pair[0])
-        target_tensor = self.tensor_from_sentence(pair[1])
-        return input_tensor, target_tensor
+    def ids_from_pair(self, pair):
+        ''' Encode a (source, target) pair into compact arrays of token ids '''
+        return tuple(self.vocab.encode(pair, eos=True))
 
     def load(self):
         return self
 
     def collate(self, data, sort=False):
         ''' Collate the data into a batch '''
-        if not data:
-            return []
-
-        def make_batch(example_ids, inputs, targets):
-            ''' Make a batch given a list of inputs and targets '''
-            # must store off lengths before padding sequence
-            input_lens = torch.LongTensor([len(input) for input in inputs])
-            target_lens = torch.LongTensor([len(target) for target in targets])
-            # print("input_lens len", len(input_lens))
-
-            batch_size = len(target_lens)
-            span_seq_len = int(
-                (len(max(targets, key=lambda x: len(x))) - 1) / self.span_size) + 1
-
-            dummy_data = torch.ones((span_seq_len * self.span_size), dtype=torch.long)
-
-            inputs = nn.utils.rnn.pad_sequence(
-                inputs, batch_first=True, padding_value=self.padding_idx)
-            targets = nn.utils.rnn.pad_sequence(
-                [dummy_data] + list(targets), batch_first=True, padding_value=self.padding_idx)[1:]
-
-            return {
-                'inputs': inputs,
-                'input_lens': input_lens,
-                'targets': targets,
-                'target_lens': target_lens,
-                'example_ids': example_ids,
-                'batch_size': batch_size,
-                'span_seq_len': span_seq_len
-            }
+        return Collator(self.padding_idx, self.sos_idx, self.span_size)(data, sort)
 
-        if any(
-                isinstance(d, tuple) and len(d) and
-                isinstance(d[0], collections.Sequence)
-                for d in data
-        ):
-            if sort:
-                # Sort within each chunk
-                data = [sorted(d, key=lambda x: len(x[1]), reverse=True) for d in data]
-
-            batch = make_batch(*zip(*list(itertools.chain.from_iterable(data))))
-            batch['chunk_sizes'] = [len(l) for l in data]
-            return batch
-        else:
-            if sort:
-                data = sorted(data, key=lambda x: len(x[1]), reverse=True)
 
-            return make_batch(*zip(*data))
+class LengthIndex(object):
+    ''' The length index of a shard of a dataset, standing in for it when only the lengths are needed '''
+    def __init__(self, dataset, lengths):
+        ''' Initialize the length index '''
+        self.lengths = lengths
+        self.span_size = dataset.span_size
+        self.binary_path = dataset.binary_path
+
+    def __len__(self):
+        ''' Get the number of examples '''
+        return len(self.lengths)
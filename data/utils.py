@@ -1,13 +1,104 @@
+import os
+import hashlib
 from functools import partial
-from data.sampler2 import RandomBatchSampler, SequenceLengthSampler
+import numpy as np
+from data.sampler2 import RandomBatchSampler, SequenceLengthSampler, SequenceLengthSampler2, PaddedTokenSampler, \
+    DistributedBatchSampler, AdaptiveBatchSampler, DeviceBatchSampler, DecodeBatchSampler, padded_target_lengths
+from data.stream import StreamingTextDataset
+from data.collate import Collator
+from data.prefetch import Prefetcher
+from model import DEVICE, NUM_DEVICES
+from utils.placement import get_placement
 
 from torch.utils.data.dataloader import DataLoader
 from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler
 
 
-def get_dataloader(dataset, config, split, worker_init_fn=None, pin_memory=True, num_devices=1, shuffle=False):
-    ''' Utility function that gets a data loader '''
-    dataset = dataset(config, config['max_length'], config['span_size'], config['filter'], split, reverse=config['reverse'], trim=config['trim'])
+def init_worker(worker_id, worker_init_fn=None, pin_workers=False, placement=None, role='data'):
+    ''' Initialize a dataloader worker, optionally placing it or pinning it to a single CPU '''
+    if placement is not None:
+        placement.apply(role, worker_id)
+    elif pin_workers:
+        # Assign CPUs from the end of the available set, leaving the lowest ones for the main process
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[-1 - worker_id % len(cpus)]})
+
+    if worker_init_fn is not None:
+        worker_init_fn(worker_id)
+
+
+def get_loader_kwargs(config, worker_init_fn=None, pin_memory=True, role='data'):
+    '''
+    Get the keyword arguments which configure the dataloader workers. The role is 'data' for
+    loading the training data and 'decode' for loading the data being evaluated.
+    '''
+    kwargs = {
+        'num_workers': config['num_workers'],
+        # Without workers, the collator already collates into pinned buffers
+        'pin_memory': pin_memory and config['num_workers'] > 0,
+        'worker_init_fn': partial(
+            init_worker, worker_init_fn=worker_init_fn, pin_workers=config['pin_workers'],
+            placement=get_placement(config), role=role
+        )
+    }
+    if config['num_workers'] > 0:
+        # Only valid when loading in worker processes
+        kwargs['prefetch_factor'] = config['prefetch_factor']
+        kwargs['persistent_workers'] = config['persistent_workers']
+
+    return kwargs
+
+
+def get_collator(dataset, config, pin_memory=True):
+    '''
+    Get a collator whose ring of buffers outlives every batch which can be in flight: the batches the
+    dataloader prefetches from all of its workers, those queued by the prefetcher (whose lengths stay
+    on the CPU even once the inputs and targets are on the device), one being pinned or staged onto
+    the device, and one in use by the training loop. Each worker has its own ring, but how many of
+    the batches in flight come from any one worker is up to the consumers, so each ring is sized for
+    all of them.
+    '''
+    max_in_flight = config['prefetch_factor'] * config['num_workers'] if config['num_workers'] > 0 else 0
+    max_in_flight += config['prefetch_batches'] + 2
+
+    return Collator(
+        dataset.padding_idx, dataset.sos_idx, dataset.span_size, max_in_flight + 1, pin_memory, max_in_flight
+    )
+
+
+def prefetch(dataloader, config):
+    ''' Optionally wrap the dataloader in a background prefetcher '''
+    if config['prefetch_batches'] > 0:
+        return Prefetcher(dataloader, DEVICE, config['prefetch_batches'])
+
+    return dataloader
+
+
+def get_plan_path(dataset, config):
+    '''
+    Get the path of the persisted batch plan of the dataset. It is keyed on everything which
+    determines the batches, including a digest of the length index, so a stale plan is never loaded.
+    Only the train split is sharded across processes, so only its plan is keyed on the world size.
+    '''
+    digest = hashlib.sha1(np.ascontiguousarray(dataset.lengths).tobytes()).hexdigest()[:16]
+    drop_last = '.drop_last' if config['drop_last'] else ''
+    world_size = f".w{config['world_size']}" if dataset.split == 'train' else ''
+    return (
+        f"{dataset.binary_path}.{config['batch_method']}.b{config['minibatch_size']}{drop_last}"
+        f"{world_size}.d{NUM_DEVICES}.{digest}.plan"
+    )
+
+
+def get_shard(config, split):
+    ''' Get the (index, num_shards) of the shard of the split this process should load, if sharded '''
+    if split == 'train' and config['shard_corpus'] and config['world_size'] > 1 and not config['stream']:
+        return (config['rank'], config['world_size'])
+
+    return None
+
+
+def get_batch_sampler(datasource, config, shuffle=False):
+    ''' Get the batch sampler for the configured batch method '''
     # if config['batch_method'] == 'token':
     #     # Calculate batch sizes for each device. Potentially reduce the batch size on device 0 as
     #     # the optimization step (all the gradients from all devices) happens on device 0.
@@ -15,39 +106,191 @@ def get_dataloader(dataset, config, split, worker_init_fn=None, pin_memory=True,
     #     batch_sizes += [config['minibatch_size']] * (num_devices - 1)
     #     batch_sampler = SequenceLengthSampler(
     #         batch_sizes,
-    #         [tuple(len(p) for p in s) for s in dataset.pairs],
+    #         [tuple(len(p) for p in s) for s in datasource.pairs],
     #         shuffle=shuffle
     #     )
 
     if config['batch_method'] == 'token':
         batch_sampler = SequenceLengthSampler(
-            dataset,
+            datasource,
+            config['minibatch_size'],
+            config['drop_last'],
+            config['shuffle'],
+            plan_path=get_plan_path(datasource, config)
+        )
+    elif config['batch_method'] == 'padded_token':
+        batch_sampler = PaddedTokenSampler(
+            datasource,
+            config['minibatch_size'],
+            config['drop_last'],
+            config['shuffle'],
+            plan_path=get_plan_path(datasource, config)
+        )
+    elif config['batch_method'] == 'target_token':
+        batch_sampler = SequenceLengthSampler2(
+            np.stack((
+                datasource.lengths[:, 0],
+                padded_target_lengths(datasource.lengths[:, 1], datasource.span_size)
+            ), axis=1),
             config['minibatch_size'],
             config['drop_last'],
             config['shuffle']
         )
     elif config['batch_method'] == 'random_batch':
         batch_sampler = RandomBatchSampler(
-            dataset,
+            datasource,
             config['minibatch_size'],
             config['drop_last'],
-            config['shuffle']
+            config['shuffle'],
+            plan_path=get_plan_path(datasource, config)
         )
     elif config['batch_method'] == 'example':
         sampler_fn = RandomSampler if shuffle else SequentialSampler
         batch_sampler = BatchSampler(
-            sampler_fn(dataset),
+            sampler_fn(datasource),
             config['minibatch_size'],
             config['drop_last']
     )
     else:
         raise ValueError('Unknown batch method!')
 
-    return DataLoader(
+    return batch_sampler
+
+
+def count_batches(datasource, config, shuffle=False):
+    '''
+    Count the batches the configured batch method makes of the datasource, e.g. a view of the shard
+    of another process, without persisting a batch plan or reporting on it
+    '''
+    samplers = {
+        'token': SequenceLengthSampler,
+        'padded_token': PaddedTokenSampler,
+        'random_batch': RandomBatchSampler
+    }
+    if config['batch_method'] in samplers:
+        return len(samplers[config['batch_method']].make_batches(
+            datasource, config['minibatch_size'], config['drop_last']
+        ))
+
+    return len(get_batch_sampler(datasource, config, shuffle))
+
+
+def get_dataloader(dataset, config, split, worker_init_fn=None, pin_memory=True, num_devices=1, shuffle=False,
+                   vocab=None):
+    ''' Utility function that gets a data loader. Pass the vocab of an existing split to share it. '''
+    dataset = dataset(config, config['max_length'], config['span_size'], config['filter'], split, reverse=config['reverse'], trim=config['trim'],
+                      binarized=config['binarize'], streaming=config['stream'], cached=config['dataset_cache'],
+                      vocab=vocab, preprocess_workers=config['preprocess_workers'],
+                      preprocess_buffer_size=config['preprocess_buffer_size'],
+                      shard=get_shard(config, split))
+
+    if config['stream']:
+        return prefetch(DataLoader(
+            StreamingTextDataset(
+                dataset,
+                config['minibatch_size'],
+                config['stream_buffer_size'],
+                config['stream_window_size'],
+                config['shuffle'],
+                config['drop_last']
+            ),
+            batch_size=None,
+            collate_fn=partial(get_collator(dataset, config, pin_memory), sort=True),
+            **get_loader_kwargs(config, worker_init_fn, pin_memory, 'data' if split == 'train' else 'decode')
+        ), config)
+
+    batch_sampler = get_batch_sampler(dataset, config, shuffle)
+
+    if split == 'train' and dataset.shard is not None:
+        # Each process only has its own shard, so count the batches of every shard from the global
+        # length index to have all processes take the same number of steps
+        batch_sampler = DistributedBatchSampler(
+            dataset,
+            batch_sampler,
+            seed=config['seed'] or 0,
+            shuffle=config['shuffle'],
+            num_batches=max(count_batches(view, config, shuffle) for view in dataset.shard_views())
+        )
+    elif split == 'train':
+        # Shard the batches across processes in a deterministic order, which a resumed run can
+        # continue mid-epoch, so even a single process checkpoints a resumable position
+        batch_sampler = DistributedBatchSampler(
+            dataset,
+            batch_sampler,
+            config['rank'],
+            config['world_size'],
+            config['seed'] or 0,
+            config['shuffle']
+        )
+
+    if split == 'train' and config['adaptive_budget']:
+        batch_sampler = AdaptiveBatchSampler(
+            dataset, batch_sampler, config['memory_high_water'], config['host_memory_limit']
+        )
+
+    if split == 'train' and config['balance_devices'] and num_devices > 1:
+        batch_sampler = DeviceBatchSampler(dataset, batch_sampler, num_devices)
+
+    return prefetch(DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=partial(get_collator(dataset, config, pin_memory), sort=True),
+        **get_loader_kwargs(config, worker_init_fn, pin_memory, 'data' if split == 'train' else 'decode')
+    ), config)
+
+
+def get_decode_budget(config, beam_width=1):
+    '''
+    Get the token budget of a decoding batch, which counts beam_width times the source plus the
+    max_length decoded tokens of each example. Unless given, each hypothesis of the beam gets the
+    token budget of a training batch, or if that counts examples, as many examples of the longest
+    source and decode.
+    '''
+    if config['decode_batch_size']:
+        return config['decode_batch_size']
+
+    budget = beam_width * config['minibatch_size']
+    if config['batch_method'] == 'example':
+        budget *= 2 * config['max_length']
+
+    return budget
+
+
+def get_decode_dataloader(dataloader, config, pin_memory=True):
+    '''
+    Get a dataloader over the split of an existing dataloader, batched by source length for decoding
+    with the configured search method rather than as for training
+    '''
+    if config['stream']:
+        # A streamed split has no length index to batch by, so stream it again in file order,
+        # numbering the examples which pass the filter so the predictions can be written in order
+        dataset = dataloader.dataset.dataset
+        return prefetch(DataLoader(
+            StreamingTextDataset(
+                dataset,
+                config['minibatch_size'],
+                config['stream_buffer_size'],
+                config['stream_window_size'],
+                contiguous_ids=True
+            ),
+            batch_size=None,
+            collate_fn=partial(get_collator(dataset, config, pin_memory), sort=True),
+            **get_loader_kwargs(config, pin_memory=pin_memory, role='decode')
+        ), config)
+
+    dataset = dataloader.dataset
+    beam_width = config['beam_width'] if config['search_method'] == 'beam' else 1
+    batch_sampler = DecodeBatchSampler(
+        dataset,
+        get_decode_budget(config, beam_width),
+        beam_width,
+        config['max_length'],
+        config['decode_window']
+    )
+
+    return prefetch(DataLoader(
         dataset,
         batch_sampler=batch_sampler,
-        collate_fn=partial(dataset.collate, sort=True),
-        num_workers=1,
-        pin_memory=pin_memory,
-        worker_init_fn=worker_init_fn
-    )
\ No newline at end of file
+        collate_fn=partial(get_collator(dataset, config, pin_memory), sort=True),
+        **get_loader_kwargs(config, pin_memory=pin_memory, role='decode')
+    ), config)
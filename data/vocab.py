@@ -0,0 +1,123 @@
+'''
+A module implementing an immutable vocabulary shared across splits and processes.
+'''
+import numpy as np
+import torch
+
+PAD = '<PAD>'
+# ALIGN = '<ALIGN>'
+SOS = '<SOS>'
+EOS = '<EOS>'
+UNK = '<UNK>'
+
+
+class Vocabulary(object):
+    '''
+    An immutable vocabulary. The words are stored as a single utf-8 buffer, so the vocabulary
+    pickles compactly to DataLoader workers and stays shared copy-on-write after a fork. The word
+    lookup structures are rebuilt lazily in each process that needs them.
+    '''
+    SPECIAL_WORDS = (PAD, SOS, EOS, UNK)
+
+    def __init__(self, words):
+        ''' Initialize the vocabulary from the list of words, ordered by index '''
+        self.buffer = np.frombuffer('\n'.join(words).encode('utf-8'), dtype=np.uint8)
+        self._words = None
+        self._word2index = None
+
+    @classmethod
+    def from_words(cls, words):
+        ''' Create a vocabulary of the special words followed by the unique words in order '''
+        seen = set(cls.SPECIAL_WORDS)
+        vocab = list(cls.SPECIAL_WORDS)
+        for word in words:
+            if word not in seen:
+                seen.add(word)
+                vocab.append(word)
+
+        return cls(vocab)
+
+    def __getstate__(self):
+        ''' Only pickle the compact buffer '''
+        return {'buffer': self.buffer, '_words': None, '_word2index': None}
+
+    def __len__(self):
+        ''' Get the number of words in the vocabulary '''
+        return len(self.words)
+
+    @property
+    def words(self):
+        ''' Get the words as an array indexed by id '''
+        if self._words is None:
+            words = self.buffer.tobytes().decode('utf-8').split('\n')
+            self._words = np.empty(len(words), dtype=object)
+            self._words[:] = words
+
+        return self._words
+
+    @property
+    def index2word(self):
+        ''' Get the word at each index '''
+        return self.words
+
+    @property
+    def word2index(self):
+        ''' Get the mapping from word to index '''
+        if self._word2index is None:
+            self._word2index = {word: idx for idx, word in enumerate(self.words)}
+
+        return self._word2index
+
+    @property
+    def dtype(self):
+        ''' Get the smallest dtype which can hold every token id '''
+        return np.dtype(np.uint16 if len(self) <= np.iinfo(np.uint16).max + 1 else np.int32)
+
+    @property
+    def padding_idx(self):
+        ''' Return the padding value '''
+        return self.word2index[PAD]
+
+    @property
+    def sos_idx(self):
+        ''' Return the start of summary value '''
+        return self.word2index[SOS]
+
+    @property
+    def eos_idx(self):
+        ''' Return the end of summary value '''
+        return self.word2index[EOS]
+
+    @property
+    def unk_idx(self):
+        ''' Return the unknown word value '''
+        return self.word2index[UNK]
+
+    def encode(self, sentences, eos=False):
+        '''
+        Encode a list of space separated sentences into a list of compact arrays of token ids (see
+        dtype), which are views into a single array. Optionally append EOS to each sentence.
+        '''
+        if not sentences:
+            return []
+
+        unk_idx = self.unk_idx
+        word2index = self.word2index
+        tokens = [sentence.split(' ') for sentence in sentences]
+        lengths = np.array([len(t) for t in tokens], dtype=np.int64) + int(eos)
+
+        ids = np.fromiter(
+            (word2index.get(word, unk_idx) for t in tokens for word in t),
+            dtype=self.dtype, count=int(lengths.sum()) - int(eos) * len(tokens)
+        )
+        if eos:
+            ids = np.insert(ids, np.cumsum(lengths - 1), self.eos_idx)
+
+        return np.split(ids, np.cumsum(lengths)[:-1])
+
+    def decode(self, ids):
+        ''' Decode an array (or tensor) of token ids of any shape into nested lists of words '''
+        if torch.is_tensor(ids):
+            ids = ids.cpu().numpy()
+
+        return self.words[np.asarray(ids, dtype=np.int64)].tolist()
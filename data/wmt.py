@@ -1,4 +1,7 @@
+import io
+import os
 import tarfile
+from contextlib import ExitStack
 from data.text import TextDataset
 
 
@@ -15,35 +18,35 @@ class WMTDataset(TextDataset):
     """
     Prepare data from WMTDataset
     """
-    def __init__(self, max_length, span_size, sort, filter, split="train", reverse=False):
-        super(WMTDataset, self).__init__(max_length, span_size, sort, filter, split, reverse)
+    def __init__(self, config, max_length, span_size, filter, split="train", reverse=False, trim=False, **kwargs):
+        self.config = config
+        self.preprocess_directory = config['preprocess_directory']
+        super(WMTDataset, self).__init__(max_length, span_size, filter, split, reverse, trim, **kwargs)
+
+    @property
+    def binary_path(self):
+        ''' Get the path prefix of the binarized split '''
+        direction = 'en_de' if self.reverse else 'de_en'
+        return os.path.join(self.preprocess_directory, f'wmt_{direction}.{self.binary_name}')
+
+    @property
+    def data_files(self):
+        ''' Get the list of files (including the vocab) the split is prepared from '''
+        return [self.TAR_PATH]
 
     def read_vocab(self):
         t = tarfile.open(WMTDataset.TAR_PATH, "r")
-        vocab = str(t.extractfile(WMTDataset.VOCAB_FILE).read(), 'utf-8').strip().split('\n')
-        for v in vocab:
-            self.add_word(v)
-
-    def read_langs(self):
-        print("Reading lines...")
-
-        t = tarfile.open(self.TAR_PATH, "r")
-
-        en_lines = str(t.extractfile('%s.bpe.32000.en' % (WMTDataset.SPLITS[self.split])).read(), 'utf-8').strip().split('\n')
-        de_lines = str(t.extractfile('%s.bpe.32000.de' % (WMTDataset.SPLITS[self.split])).read(), 'utf-8').strip().split('\n')
-
-        # Split every line into pairs
-        pairs = [[s1, s2] for s1, s2 in zip(de_lines, en_lines)]
-
-        # Reverse pairs, make Lang instances
-        if self.reverse:
-            pairs = [list(reversed(p)) for p in pairs]
-
-        print("Read %s sentence pairs in %s" % (len(pairs), self.split))
-        if self.filter:
-            pairs = self.filter_pairs(pairs)
-        print("Trimmed to %s sentence pairs" % len(pairs))
-        if self.sort:
-            pairs = sorted(pairs, key=lambda x: len(x[1]))
-
-        self.pairs = pairs
\ No newline at end of file
+        return str(t.extractfile(WMTDataset.VOCAB_FILE).read(), 'utf-8').strip().split('\n')
+
+    def read_lines(self):
+        ''' Lazily yield the (de, en) line pairs of the split straight out of the tar '''
+        with ExitStack() as stack:
+            files = []
+            for lang in ('de', 'en'):
+                # Separate handles, so each member is only ever read forward through the gzip stream
+                tar = stack.enter_context(tarfile.open(self.TAR_PATH, "r"))
+                member = tar.extractfile('%s.bpe.32000.%s' % (WMTDataset.SPLITS[self.split], lang))
+                files.append(io.TextIOWrapper(member, encoding='utf-8'))
+
+            for lines in zip(*files):
+                yield tuple(line.rstrip('\r\n') for line in lines)
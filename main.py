@@ -3,11 +3,13 @@ Main entrance of the program
 """
 
 
+import os
 from comet_ml import Experiment
 import torch
-from model.utils import save_predictions, get_random_seed_fn
+from model.utils import PredictionWriter, get_random_seed_fn
+from utils.placement import get_placement
 from args import get_cl_args
-from data.utils import get_dataloader
+from data.utils import get_dataloader, get_decode_dataloader
 from data.wmt import WMTDataset
 from data.iwslt import IWSLTDataset
 from actions.train import Trainer
@@ -54,10 +56,13 @@ def main():
         'length_penalty': args.length_penalty,
         'drop_last': args.drop_last,
         'beam_width': args.beam_width,
+        'decode_batch_size': args.decode_batch_size,
+        'decode_window': args.decode_window,
         'beam_search_all': args.beam_search_all,
         'clip': args.clip,
         'search_method': args.search_method,
         'eval_when_train': args.eval_when_train,
+        'valid_cache': args.valid_cache,
         'filter': args.filter,
         'detokenize': args.detokenize,
         'rnn_type': args.rnn_type,
@@ -79,9 +84,35 @@ def main():
         'accumulate_steps': args.accumulate_steps,
         'reverse': args.reverse,
         'preprocess_directory': args.preprocess_directory,
-        'preprocess_buffer_size': args.preprocess_buffer_size
+        'preprocess_buffer_size': args.preprocess_buffer_size,
+        'preprocess_workers': args.preprocess_workers or max(1, os.cpu_count() // args.world_size),
+        'rank': args.rank,
+        'world_size': args.world_size,
+        'shard_corpus': args.shard_corpus,
+        'adaptive_budget': args.adaptive_budget,
+        'memory_high_water': args.memory_high_water,
+        'host_memory_limit': int(args.host_memory_limit * 2 ** 30) if args.host_memory_limit else None,
+        'balance_devices': args.balance_devices,
+        'binarize': args.binarize,
+        'dataset_cache': args.dataset_cache,
+        'stream': args.stream,
+        'stream_buffer_size': args.stream_buffer_size,
+        'stream_window_size': args.stream_window_size,
+        'num_workers': args.num_workers,
+        'prefetch_factor': args.prefetch_factor,
+        'prefetch_batches': args.prefetch_batches,
+        'persistent_workers': args.persistent_workers,
+        'pin_workers': args.pin_workers,
+        'placement': args.placement,
+        'placement_node': args.placement_node,
+        'inter_op_threads': args.inter_op_threads
     }
 
+    placement = get_placement(config)
+    if placement is not None:
+        placement.apply()
+        print(placement.report())
+
     # config dataloader
 
     datasets = {"WMT": WMTDataset, "IWSLT": IWSLTDataset}
@@ -100,14 +131,19 @@ def main():
         NUM_DEVICES, shuffle=args.shuffle
     )
 
+    # All the splits share the vocab loaded for the training split
+    vocab = dataloader_train.dataset.vocab
+
+    # Cached validation batches are replayed in the order they were first loaded, so do not shuffle
+    valid_shuffle = args.shuffle and config['valid_cache'] == 'none'
     dataloader_valid = get_dataloader(
-        dataset, config, "valid", args.seed_fn, pin_memory,
-        NUM_DEVICES, shuffle=args.shuffle
+        dataset, dict(config, shuffle=valid_shuffle), "valid", args.seed_fn, pin_memory,
+        NUM_DEVICES, shuffle=valid_shuffle, vocab=vocab
     )
 
     dataloader_test = get_dataloader(
         dataset, config, "test", args.seed_fn, pin_memory,
-        NUM_DEVICES, shuffle=args.shuffle
+        NUM_DEVICES, shuffle=args.shuffle, vocab=vocab
     )
 
     # define the models
@@ -159,23 +195,29 @@ def main():
             trainer.restore_checkpoint(args.experiment_path + args.restore)
         trainer.train()
     elif args.mode == "evaluate":
-        evaluator = Evaluator(config=config, models=models, dataloader=dataloader_valid, experiment=experiment)
+        evaluator = Evaluator(config=config, models=models,
+                              dataloader=get_decode_dataloader(dataloader_valid, config, pin_memory),
+                              experiment=experiment)
         if args.restore is not None:
             evaluator.restore_checkpoint(args.experiment_path + args.restore)
-        preds = evaluator.evaluate(args.search_method)
-        save_predictions(preds, args.evaluate_path, args.detokenize)
+        with PredictionWriter(args.evaluate_path, args.detokenize) as writer:
+            evaluator.evaluate(args.search_method, writer)
     elif args.mode == "evaluate_train":
-        evaluator = Evaluator(config=config, models=models, dataloader=dataloader_train, experiment=experiment)
+        evaluator = Evaluator(config=config, models=models,
+                              dataloader=get_decode_dataloader(dataloader_train, config, pin_memory),
+                              experiment=experiment)
         if args.restore is not None:
             evaluator.restore_checkpoint(args.experiment_path + args.restore)
-        preds = evaluator.evaluate(args.search_method)
-        save_predictions(preds, args.evaluate_path, args.detokenize)
+        with PredictionWriter(args.evaluate_path, args.detokenize) as writer:
+            evaluator.evaluate(args.search_method, writer)
     elif args.mode == "test":
-        evaluator = Evaluator(config=config, models=models, dataloader=dataloader_test, experiment=experiment)
+        evaluator = Evaluator(config=config, models=models,
+                              dataloader=get_decode_dataloader(dataloader_test, config, pin_memory),
+                              experiment=experiment)
         if args.restore is not None:
             evaluator.restore_checkpoint(args.experiment_path + args.restore)
-        preds = evaluator.evaluate(args.search_method)
-        save_predictions(preds, args.evaluate_path, args.detokenize)
+        with PredictionWriter(args.evaluate_path, args.detokenize) as writer:
+            evaluator.evaluate(args.search_method, writer)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,14 @@
 import torch
 import time
 from model import utils, DEVICE, EOS_token
+from model.rnmt_plus import DecoderState
 
 
 class BeamHypothesis(object):
-    def __init__(self, sequence, score, hidden):
+    def __init__(self, sequence, score, row):
         self.sequence = sequence
         self.score = score
-        self.hidden = hidden
+        self.row = row  # the row of its decoder state in the batch last decoded
         self.finish = False
 
     def __len__(self):
@@ -16,10 +17,10 @@ class BeamHypothesis(object):
 
 
 class Beam(object):
-    def __init__(self, start_sequence, hidden, initial_score=0., max_length=0, width=4):
+    def __init__(self, start_sequence, row, initial_score=0., max_length=0, width=4):
         self.width = width
         self.max_length = max_length
-        self.hypotheses = [BeamHypothesis(start_sequence, initial_score, hidden)]
+        self.hypotheses = [BeamHypothesis(start_sequence, initial_score, row)]
 
     @property
     def best_hypothesis(self):
@@ -33,22 +34,18 @@ class Beam(object):
     def collate(self):
         sequences = []
         scores = []
-        hiddens = []
-        cells = []
+        rows = []
         for hypothesis in self.hypotheses:
             sequences.append(hypothesis.sequence.unsqueeze(0))
             # print("sequence", hypothesis.sequence)
             # print("sequence type", type(hypothesis.sequence))
             scores.append(hypothesis.score)
-            hiddens.append(hypothesis.hidden[0])
-            cells.append(hypothesis.hidden[1])
+            rows.append(int(hypothesis.row))
         # print("lists")
         # print("sequences", len(sequences), sequences[0].size())
         # print("scores", scores[0])
-        # print("hiddens", len(hiddens), hiddens[0].size())
 
-        return torch.cat(sequences, 0), torch.tensor(scores, dtype=torch.float32).to(DEVICE), \
-               (torch.cat(hiddens, 0), torch.cat(cells, 0))
+        return torch.cat(sequences, 0), torch.tensor(scores, dtype=torch.float32).to(DEVICE), rows
 
 
 class BeamSearchDecoder(object):
@@ -66,8 +63,8 @@ class BeamSearchDecoder(object):
         if isinstance(initial_scores, int):
             initial_scores = [initial_scores] * len(start_sequences)
 
-        for sequence, score, max_length in zip(start_sequences, initial_scores, max_lengths):
-            beams.append(Beam(sequence, score, max_length, beam_width))
+        for row, (sequence, score, max_length) in enumerate(zip(start_sequences, initial_scores, max_lengths)):
+            beams.append(Beam(sequence, row, score, max_length, beam_width))
 
         return beams
 
@@ -80,25 +77,27 @@ class BeamSearchDecoder(object):
         """
         return score * ((5 + 1) / (5 + length)) ** self.config['length_penalty']
 
-    def collate(self, encoder_outputs, beams):
+    def collate(self, beams):
+        ''' Collate the hypotheses of the beams, along with the rows of their decoder states '''
         sequences = []
         scores = []
-        hiddens = []
-        cells = []
-        encoder_batch = []
+        rows = []
         for i, beam in enumerate(beams):
-            sequence, score, hidden = beam.collate()
+            sequence, score, row = beam.collate()
             sequences.append(sequence)
             scores.append(score)
-            hiddens.append(hidden[0])
-            cells.append(hidden[1])
-            encoder_batch.append(encoder_outputs[i].unsqueeze(0).expand(sequence.size()[0],
-                                                                        encoder_outputs[i].size()[0],
-                                                                        encoder_outputs[i].size()[1]))
-        return torch.cat(sequences, 0), torch.cat(scores, 0), (torch.cat(hiddens, 0), torch.cat(cells, 0)), \
-               torch.cat(encoder_batch, 0)
-
-    def search_all(self, sequences, topv, topi, scores, hiddens):
+            rows.extend(row)
+        return torch.cat(sequences, 0), torch.cat(scores, 0), torch.tensor(rows, dtype=torch.long, device=DEVICE)
+
+    def expand_state(self, attention_state, beams):
+        ''' Expand the attention state of each example to the number of hypotheses in its beam '''
+        counts = [len(beam.hypotheses) for beam in beams]
+        if len(set(counts)) == 1:
+            return attention_state.expand(counts[0])
+
+        return attention_state.expand(counts)
+
+    def search_all(self, sequences, topv, topi, scores):
         new_scores = scores
 
         # Project each position's beam_width number of candidates to a 2d vector in a beam_width + 2 d space,
@@ -115,11 +114,11 @@ class BeamSearchDecoder(object):
                 new_subseq.append(dim_idx[i])
         return [BeamHypothesis(torch.cat(sequences[new_subseq[0]],
                                          topi[new_subseq[0]][range(self.config['span_size']), new_subseq[1:]]),
-                               new_topv[i], hiddens[new_subseq[0]])
+                               new_topv[i], new_subseq[0])
                 for i, new_subseq in enumerate(top_indices)]
 
-    def search_sequential_batch(self, sequences, topv, topi, scores, hiddens, batch_size):
-        spb = sequences.size()[0] / batch_size  # sequences per batch
+    def search_sequential_batch(self, sequences, topv, topi, scores, batch_size):
+        spb = sequences.size()[0] // batch_size  # sequences per batch
         for s in range(self.config['span_size']):
             if s == 0:
                 newscores = scores.view(-1, 1).to('cpu') + topv[:, s, :].view(-1, self.config['beam_width']).to('cpu')
@@ -137,7 +136,6 @@ class BeamSearchDecoder(object):
                 c_matrix = topsv
                 need_norm = lengths < b_matrix.size()[-1]
                 c_matrix[need_norm] = self.normalized_score(c_matrix[need_norm], lengths[need_norm] - self.config['span_size'])  # new scores
-                d_matrix = (hiddens[0][a_matrix], hiddens[1][a_matrix])  # hidden states and cell states copied over
             else:
                 a_matrix = torch.gather(a_matrix, 1, rowsi)
                 b_matrix_size = b_matrix.size()
@@ -150,14 +148,11 @@ class BeamSearchDecoder(object):
                 c_matrix = topsv
                 need_norm = lengths < b_matrix.size()[-1]
                 c_matrix[need_norm] = self.normalized_score(c_matrix[need_norm], lengths[need_norm] - self.config['span_size'])
-                d_matrix_size = d_matrix[0].size()
-                d_matrix = (d_matrix[0][indices, rowsi.view(-1)].view(d_matrix_size),
-                            d_matrix[1][indices, rowsi.view(-1)].view(d_matrix_size))
-        return [[BeamHypothesis(b_matrix[j, i], c_matrix[j, i], (d_matrix[0][j, i].unsqueeze(0), d_matrix[1][j, i].unsqueeze(0)))
+        return [[BeamHypothesis(b_matrix[j, i], c_matrix[j, i], a_matrix[j, i])
                  for i in range(self.config['beam_width'])]for j in range(batch_size)]
 
-    def search_sequential_single(self, sequences, topv, topi, scores, hiddens, batch_size):
-        spb = sequences.size()[0] / batch_size  # sequences per batch
+    def search_sequential_single(self, sequences, topv, topi, scores, batch_size):
+        spb = sequences.size()[0] // batch_size  # sequences per batch
         all_ended = False
         for s in range(self.config['span_size']):
             if s == 0:
@@ -178,7 +173,6 @@ class BeamSearchDecoder(object):
                 if torch.sum(need_norm).item() == c_matrix.size()[0]:
                     all_ended = True
                 c_matrix[need_norm] = self.normalized_score(c_matrix[need_norm], lengths[need_norm] - self.config['span_size'])  # new scores
-                d_matrix = (hiddens[0][a_matrix], hiddens[1][a_matrix])  # hidden states and cell states copied over
                 if all_ended:
                     break
             else:
@@ -193,48 +187,48 @@ class BeamSearchDecoder(object):
                 c_matrix = topsv
                 need_norm = lengths < b_matrix.size()[-1]
                 c_matrix[need_norm] = self.normalized_score(c_matrix[need_norm], lengths[need_norm] - self.config['span_size'])
-                d_matrix_size = d_matrix[0].size()
-                d_matrix = (d_matrix[0][indices, rowsi.view(-1)].view(d_matrix_size),
-                            d_matrix[1][indices, rowsi.view(-1)].view(d_matrix_size))
-        return [[BeamHypothesis(b_matrix[j, i], c_matrix[j, i], (d_matrix[0][j, i].unsqueeze(0), d_matrix[1][j, i].unsqueeze(0)))
+        return [[BeamHypothesis(b_matrix[j, i], c_matrix[j, i], a_matrix[j, i])
                  for i in range(self.config['beam_width'])]for j in range(batch_size)], all_ended
 
-    def decode_batch(self, encoder_outputs, encoder_hidden, start_sequences):
+    def decode_batch(self, encoder_outputs, encoder_hidden, start_sequences, input_lens=None):
         self.decoder.eval()
         batch_size = len(encoder_outputs)
         with torch.no_grad():
-            decoder_hidden = torch.zeros(batch_size, self.config['num_layers'] + 1 + self.config['more_decoder_layers'],
-                                         self.config['hidden_size'],
-                                         device=DEVICE)
-            decoder_cell = torch.zeros(batch_size, self.config['num_layers'] + 1 + self.config['more_decoder_layers'],
-                                       self.config['hidden_size'],
-                                       device=DEVICE)
-            encoded_hidden_list = utils.split_or_chunk((encoder_outputs, decoder_hidden,
-                                                        decoder_cell),
-                                                       batch_size)
-            beams = [Beam(start_sequences[i], (row[1], row[2]), self.initial_score,
-                            self.config['max_length'], self.config['beam_width']) for i, row in enumerate(encoded_hidden_list)]
+            decoder = getattr(self.decoder, 'module', self.decoder)
+            beams = [Beam(start_sequences[i], i, self.initial_score,
+                            self.config['max_length'], self.config['beam_width']) for i in range(batch_size)]
+
+            # Project the attention keys and values once, then only expand them when the number of
+            # hypotheses per beam changes. All the hypotheses of a beam share the same source, so
+            # reordering them within the beam leaves the state as is.
+            attention_state = decoder.init_state(encoder_outputs, input_lens)
+            beam_state = None
+            beam_sizes = None
+
+            # Each hypothesis keeps the row of its decoder state in the batch last decoded, so the
+            # next batch of states is that batch reordered by index
+            decoder_state = decoder.zero_state(batch_size)
 
             for l in range(int(self.config['max_length']/self.config['span_size'])):
-                sequences, scores, hiddens, encoder_batch = self.collate(encoder_outputs, beams)
+                sequences, scores, rows = self.collate(beams)
+                if beam_sizes != [len(beam.hypotheses) for beam in beams]:
+                    beam_sizes = [len(beam.hypotheses) for beam in beams]
+                    beam_state = self.expand_state(attention_state, beams)
+
+                decoder_state = decoder_state.select(rows)
                 decoder_output, decoder_hidden, decoder_cell, decoder_attn \
                     = self.decoder(sequences[:, -self.config['span_size']:],
-                                   hiddens[0].transpose(0, 1),
-                                   hiddens[1].transpose(0, 1),
-                                   encoder_batch)
+                                   decoder_state.hiddens,
+                                   decoder_state.cells,
+                                   beam_state)
+                decoder_state = DecoderState(decoder_hidden, decoder_cell)
                 topv, topi = decoder_output.topk(self.config['beam_width'], dim=2)
                 # if self.config['beam_search_all']:
-                #     new_hypotheses = self.search_all(sequences, topv, topi, scores,
-                #                                      (decoder_hidden.transpose(0, 1), decoder_cell.transpose(0, 1)))
+                #     new_hypotheses = self.search_all(sequences, topv, topi, scores)
                 # else:
                 # new_hypotheses, all_ended = self.search_sequential_single(sequences, topv, topi, scores,
-                #                                               (decoder_hidden.transpose(0, 1),
-                #                                                decoder_cell.transpose(0, 1)),
                 #                                               batch_size)
-                new_hypotheses = self.search_sequential_batch(sequences, topv, topi, scores,
-                                                                          (decoder_hidden.transpose(0, 1),
-                                                                           decoder_cell.transpose(0, 1)),
-                                                                          batch_size)
+                new_hypotheses = self.search_sequential_batch(sequences, topv, topi, scores, batch_size)
                 for i, new_hypothesis in enumerate(new_hypotheses):
                     beams[i].hypotheses = new_hypothesis
                 # if all_ended:
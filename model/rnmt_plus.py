@@ -1,9 +1,205 @@
+import collections
+import itertools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from model import PAD_token, SOS_token, EOS_token, DEVICE
 
 
+class AttentionState(collections.namedtuple('AttentionState', ['keys', 'values', 'lengths', 'groups'])):
+    '''
+    The B x S x H keys and values of the decoder attention, projected from the encoder outputs once
+    per batch rather than at every decode step, along with the source lengths (if known) to mask
+    the padding, and the length groups of the rows (see length_groups). The groups are computed
+    once with the state, and model.utils.ChunkedDataParallel scatters the state with the groups of
+    each replica's rows (see scatter), so no decode step has to recompute them.
+    '''
+    @classmethod
+    def from_tensors(cls, keys, values, lengths=None):
+        ''' Make the state, grouping the rows by the lengths '''
+        return cls(keys, values, lengths, length_groups(lengths))
+
+    def select(self, indices):
+        ''' Get the state of the given rows, e.g. to expand or reorder it for the hypotheses of beams '''
+        return AttentionState.from_tensors(*(
+            tensor.index_select(0, indices) if tensor is not None else None
+            for tensor in self[:3]
+        ))
+
+    def expand(self, beam_widths):
+        '''
+        Repeat the state of each example for each of the hypotheses of its beam, given the number of
+        hypotheses of every beam, or of each beam. The groups are expanded along with the rows.
+        '''
+        if isinstance(beam_widths, int):
+            repeats = beam_widths
+            beam_widths = [beam_widths] * len(self.keys)
+        else:
+            repeats = torch.tensor(beam_widths, device=self.keys.device)
+
+        groups = None
+        if self.groups is not None:
+            offsets = [0] + list(itertools.accumulate(beam_widths))
+            groups = tuple(
+                (offsets[start], offsets[end], length)
+                for start, end, length in self.groups
+                if offsets[start] < offsets[end]
+            ) or None
+
+        return AttentionState(*(
+            tensor.repeat_interleave(repeats, dim=0) if tensor is not None else None
+            for tensor in self[:3]
+        ), groups)
+
+    def scatter(self, scatter_map, chunk_sizes):
+        '''
+        Scatter the state in the given chunk sizes of rows, using the scatter_map of a data parallel
+        module for the tensors. The groups of each chunk are its rows of the groups of the state.
+        '''
+        states = []
+        start = 0
+        for tensors, chunk_size in zip(zip(*map(scatter_map, self[:3])), chunk_sizes):
+            end = start + chunk_size
+            groups = None
+            if self.groups is not None:
+                groups = tuple(
+                    (max(group_start, start) - start, min(group_end, end) - start, length)
+                    for group_start, group_end, length in self.groups
+                    if group_start < end and group_end > start
+                )
+
+            states.append(AttentionState(*tensors, groups))
+            start = end
+
+        return states
+
+
+class DecoderState(collections.namedtuple('DecoderState', ['hiddens', 'cells'])):
+    '''
+    The B x H hidden and cell states of each RNN layer of the decoder, as tuples with one tensor per
+    layer. A decode step is functional: it returns the states the RNNs output as a new state rather
+    than cloning the given one and writing into it, so each step allocates nothing beyond the RNN
+    outputs and autograd keeps every step's state as is. Like AttentionState, the tuples of batch
+    first tensors get scattered along the batch by nn.DataParallel. With GRUs the cells are unused
+    and passed through unchanged.
+    '''
+    @classmethod
+    def zeros(cls, num_layers, batch_size, hidden_size, device=DEVICE):
+        ''' Make the initial state, where every layer is a view of a single preallocated buffer '''
+        buffer = torch.zeros(2, num_layers, batch_size, hidden_size, device=device)
+        return cls(buffer[0].unbind(0), buffer[1].unbind(0))
+
+    def select(self, indices):
+        ''' Get the state of the given rows, e.g. to reorder it for the hypotheses of beams '''
+        return DecoderState(
+            tuple(hidden.index_select(0, indices) for hidden in self.hiddens),
+            tuple(cell.index_select(0, indices) for cell in self.cells)
+        )
+
+
+def length_groups(lengths, max_padding=0.5):
+    '''
+    Group runs of consecutive rows by length, where each row of a group is longer than
+    (1 - max_padding) of its longest row. Batches are sorted by source length, so the runs are long,
+    and each group is a plain range of rows. Returns a tuple of (start row, end row, group length),
+    or None if a single group suffices. Pass CPU lengths to avoid waiting on the device.
+    '''
+    if lengths is None:
+        return None
+
+    groups = []
+    for row, length in enumerate(lengths.tolist()):
+        if groups:
+            start, end, shortest, longest = groups[-1]
+            if max(longest, length) * (1 - max_padding) < min(shortest, length):
+                groups[-1] = [start, row + 1, min(shortest, length), max(longest, length)]
+                continue
+
+        groups.append([row, row + 1, length, length])
+
+    if len(groups) <= 1:
+        return None
+
+    return tuple((start, end, longest) for start, end, _, longest in groups)
+
+
+def project_keys_values(attention, encoder_outputs, lengths=None):
+    ''' Project B x S x H encoder outputs into the keys and values of a nn.MultiheadAttention '''
+    embed_dim = attention.embed_dim
+    weight = attention.in_proj_weight
+    bias = attention.in_proj_bias
+
+    keys, values = (
+        F.linear(encoder_outputs, weight[start:start + embed_dim],
+                 bias[start:start + embed_dim] if bias is not None else None)
+        for start in (embed_dim, 2 * embed_dim)
+    )
+    if lengths is None:
+        return AttentionState(keys, values, None, None)
+
+    # Group by the lengths before moving them, so grouping does not wait on the device
+    return AttentionState(keys, values, lengths.to(encoder_outputs.device), length_groups(lengths))
+
+
+def attend_heads(attention, queries, keys, values, lengths=None):
+    '''
+    Compute the attention of the projected B x heads x T x head_dim queries over the projected
+    B x heads x S x head_dim keys and values, masking the keys past the lengths if given
+    '''
+    scores = torch.matmul(queries, keys.transpose(2, 3))
+    if lengths is not None:
+        padding = torch.arange(keys.size()[2], device=keys.device) >= lengths[:, None]
+        scores = scores.masked_fill(padding[:, None, None, :], float('-inf'))
+
+    weights = F.softmax(scores, dim=-1)
+    weights = F.dropout(weights, p=attention.dropout, training=attention.training)
+
+    return torch.matmul(weights, values), weights
+
+
+def attend(attention, queries, state):
+    '''
+    Apply a nn.MultiheadAttention to B x T x H queries over the projected keys and values of the
+    state, so only the queries get projected. Returns the B x T x H outputs and the B x T x S
+    weights averaged over the heads, the same as attention(queries, encoder_outputs,
+    encoder_outputs) with the sequences first, with a key_padding_mask if the state has lengths.
+
+    When the lengths vary widely, each group of rows of similar length only attends over the
+    keys up to its longest length, so the padding beyond costs nothing.
+    '''
+    bsz, tgt_len, embed_dim = queries.size()
+    num_heads = attention.num_heads
+    head_dim = embed_dim // num_heads
+
+    bias = attention.in_proj_bias
+    queries = F.linear(queries, attention.in_proj_weight[:embed_dim], bias[:embed_dim] if bias is not None else None)
+    queries = queries * head_dim ** -0.5
+
+    # B x heads x length x head_dim
+    queries = queries.view(bsz, tgt_len, num_heads, head_dim).transpose(1, 2)
+    keys, values = (tensor.view(bsz, -1, num_heads, head_dim).transpose(1, 2) for tensor in state[:2])
+
+    if state.groups is None:
+        output, weights = attend_heads(attention, queries, keys, values, state.lengths)
+    else:
+        outputs = []
+        group_weights = []
+        for start, end, length in state.groups:
+            output, weights = attend_heads(
+                attention, queries[start:end], keys[start:end, :, :length], values[start:end, :, :length],
+                state.lengths[start:end]
+            )
+            outputs.append(output)
+            group_weights.append(F.pad(weights, (0, keys.size()[2] - length)))
+
+        output = torch.cat(outputs, 0)
+        weights = torch.cat(group_weights, 0)
+
+    output = output.transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+    return attention.out_proj(output), weights.mean(dim=1)
+
+
 class RNMTPlusEncoderRNN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers=1, dropout_p=0.1, rnn_type="GRU", num_directions=1):
         super(RNMTPlusEncoderRNN, self).__init__()
@@ -26,12 +222,20 @@ class RNMTPlusEncoderRNN(nn.Module):
 
     def forward(self, input_seqs, input_lengths, total_length, hidden=None):
         embedded = self.embedding(input_seqs)
-        output = self.dropout(embedded)
+
+        # Pack once and keep the activations packed through all the layers, so the layers never
+        # process the padding. Sub-batches are only sorted within each replica's chunk, so do not
+        # require sorted lengths.
+        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lengths, batch_first=True,
+                                                         enforce_sorted=False)
+        output = packed._replace(data=self.dropout(packed.data))
 
         for encoder_layer in self.encoder_layers:
-            output, hidden, cell = encoder_layer(output, input_lengths)
+            output, hidden, cell = encoder_layer.forward_packed(output)
 
-        output = self.projection(output)
+        # Project the packed data, so the padding pad_packed_sequence adds stays exactly zero
+        output = output._replace(data=self.projection(output.data))
+        output, _ = torch.nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=total_length)
 
         return output, hidden, cell
 
@@ -64,7 +268,8 @@ class RNMTPlusEncoderLayer(nn.Module):
         hidden = torch.zeros(self.num_layers * self.num_directions, batch_size, self.hidden_size, device=DEVICE)
         cell = torch.zeros(self.num_layers * self.num_directions, batch_size, self.hidden_size, device=DEVICE)
 
-        packed = torch.nn.utils.rnn.pack_padded_sequence(inputs, input_lengths, batch_first=True)
+        # Sub-batches are only sorted within each replica's chunk, so do not require sorted lengths
+        packed = torch.nn.utils.rnn.pack_padded_sequence(inputs, input_lengths, batch_first=True, enforce_sorted=False)
 
         if self.rnn_type == "GRU":
             self.gru.flatten_parameters()
@@ -82,6 +287,26 @@ class RNMTPlusEncoderLayer(nn.Module):
         output = inputs + output
         return output, hidden, cell
 
+    def forward_packed(self, inputs):
+        '''
+        Apply the layer to a PackedSequence, returning the output as a PackedSequence too. The layer
+        norm, dropout and residual connection are all applied to the packed data directly.
+        '''
+        if self.rnn_type == "GRU":
+            self.gru.flatten_parameters()
+            output, hidden = self.gru(inputs)
+            cell = torch.zeros_like(hidden)
+        else:
+            self.lstm.flatten_parameters()
+            output, (hidden, cell) = self.lstm(inputs)
+
+        data = self.layer_norm(output.data)
+        if self.num_directions == 2:
+            data = self.convert(data.view(-1, self.num_directions, self.hidden_size).transpose(1, 2)).squeeze(2)
+        data = self.dropout(data)
+
+        return inputs._replace(data=inputs.data + data), hidden, cell
+
     def init_rnn(self):
         if self.rnn_type == "GRU":
             for name, param in self.gru.named_parameters():
@@ -122,9 +347,62 @@ class RNMTPlusDecoderRNN(nn.Module):
             self.lstm = nn.LSTM(self.hidden_size, self.hidden_size, 1, dropout=self.dropout_p, batch_first=True)
         self.out = nn.Linear(self.hidden_size, self.output_size * span_size)
 
-    def forward(self, inputs, hiddens, cells, encoder_outputs):
+    def init_state(self, encoder_outputs, input_lens=None):
+        '''
+        Project the B x S x H encoder outputs into the keys and values of the attention. Pass the
+        state in place of the encoder outputs, so each decode step only projects its queries. With
+        the input_lens, the attention does not attend to the padding of the encoder outputs.
+        '''
+        return project_keys_values(self.multihead_attn, encoder_outputs, input_lens)
+
+    def attention_state(self, encoder_outputs, input_lens=None):
+        ''' Get the attention state, given either the state or the encoder outputs '''
+        if isinstance(encoder_outputs, AttentionState):
+            return encoder_outputs
+
+        if isinstance(encoder_outputs, tuple):
+            # A plain tuple once scattered by nn.DataParallel, whose groups are those of the whole
+            # batch, so group the rows of this replica again
+            return AttentionState.from_tensors(*encoder_outputs[:3])
+
+        return self.init_state(encoder_outputs, input_lens)
+
+    def zero_state(self, batch_size, device=DEVICE):
+        ''' Get the initial DecoderState of a batch, with a state for the bottom RNN and each layer '''
+        return DecoderState.zeros(len(self.decoder_layers) + 1, batch_size, self.hidden_size, device)
+
+    def step(self, embeddeds, hiddens, cells, attention_state):
+        '''
+        Run B x T x H embedded spans through the bottom RNN, the attention and the decoder layers,
+        starting from the per layer states in hiddens and cells. Returns the B x T x 2H combined
+        outputs, the new DecoderState and the attention weights.
+        '''
+        if self.rnn_type == "GRU":
+            self.gru.flatten_parameters()
+            rnn_output, hidden = self.gru(embeddeds, hiddens[0].unsqueeze(0))
+            cell = cells[0]
+        else:
+            self.lstm.flatten_parameters()
+            rnn_output, (hidden, cell) = self.lstm(embeddeds, (hiddens[0].unsqueeze(0), cells[0].unsqueeze(0)))
+            cell = cell.squeeze(0)
+        new_hiddens = [hidden.squeeze(0)]
+        new_cells = [cell]
+
+        attn_output, attn_output_weights = attend(self.multihead_attn, rnn_output, attention_state)
+        for i, decoder_layer in enumerate(self.decoder_layers):
+            rnn_output, hidden, cell = decoder_layer(rnn_output, hiddens[i+1], cells[i+1], attn_output)
+            new_hiddens.append(hidden)
+            new_cells.append(cell)
+
+        output = torch.cat((rnn_output, attn_output), 2)
+        return output, DecoderState(tuple(new_hiddens), tuple(new_cells)), attn_output_weights
+
+    def forward(self, inputs, hiddens, cells, encoder_outputs, full_sequence=False, input_lens=None):
         # Assume inputs is padded to max length, max_length is multiple of span_size
         # ==========================================================================
+        if full_sequence:
+            # Passed as a flag so the full sequence path also works through nn.DataParallel
+            return self.forward_sequence(inputs, hiddens, cells, encoder_outputs, input_lens)
 
         bsz = inputs.size()[0]
         embeddeds = self.embedding(inputs)  # B x S -> B x S x H
@@ -133,27 +411,38 @@ class RNMTPlusDecoderRNN(nn.Module):
 
         embeddeds = self.cat_embeddings(embeddeds).unsqueeze(1)
 
-        if self.rnn_type == "GRU":
-            self.gru.flatten_parameters()
-            rnn_output, hiddens[0] = self.gru(embeddeds, hiddens[0].clone().unsqueeze(0))
-        else:
-            self.lstm.flatten_parameters()
-            rnn_output, (hiddens[0], cells[0]) = self.lstm(embeddeds, (hiddens[0].clone().unsqueeze(0), cells[0].clone().unsqueeze(0)))
+        output, state, attn_output_weights = self.step(embeddeds, hiddens, cells,
+                                                       self.attention_state(encoder_outputs, input_lens))
+        output = self.attn_combine(output)
+        output = self.out(output).view(bsz, self.span_size, -1)
+        output = F.log_softmax(output, dim=2)
 
-        attn_output, attn_output_weights = self.multihead_attn(rnn_output.transpose(0, 1),
-                                                               encoder_outputs.transpose(0, 1),
-                                                               encoder_outputs.transpose(0, 1))
+        # Plain tuples, which nn.DataParallel can gather
+        return output, state.hiddens, state.cells, attn_output_weights
+
+    def forward_sequence(self, inputs, hiddens, cells, encoder_outputs, input_lens=None):
+        '''
+        Decode a whole B x (T x S) sequence of teacher forced inputs at once. The bottom RNN only
+        depends on the inputs, the attention only on the bottom RNN, and each decoder layer only on
+        the layer below it and the attention. So rather than running every layer T times on a single
+        step, each runs once over all T steps, giving the same outputs as calling forward for each
+        span of the inputs in turn. Returns B x (T x S) x V log probabilities.
+        '''
+        bsz = inputs.size()[0]
+        embeddeds = self.embedding(inputs)  # B x (T x S) -> B x (T x S) x H
+        embeddeds = embeddeds.view(bsz, -1, self.span_size * self.hidden_size)  # B x T x (S x H)
+        embeddeds = self.dropout(embeddeds)
 
-        attn_output = attn_output.transpose(0, 1)
-        for i, decoder_layer in enumerate(self.decoder_layers):
-            rnn_output, hiddens[i+1], cells[i+1] = decoder_layer(rnn_output, hiddens[i+1].clone(), cells[i+1].clone(), attn_output)
+        embeddeds = self.cat_embeddings(embeddeds)  # B x T x H
 
-        output = torch.cat((rnn_output, attn_output), 2)
+        # Each step attends independently, so all T queries attend at once
+        output, state, attn_output_weights = self.step(embeddeds, hiddens, cells,
+                                                       self.attention_state(encoder_outputs, input_lens))
         output = self.attn_combine(output)
-        output = self.out(output).view(bsz, self.span_size, -1)
+        output = self.out(output).view(bsz, -1, self.output_size)  # B x (T x S) x V
         output = F.log_softmax(output, dim=2)
 
-        return output, hiddens, cells, attn_output_weights
+        return output, state.hiddens, state.cells, attn_output_weights
 
     def init_rnn(self):
         if self.rnn_type =="GRU":
@@ -192,16 +481,18 @@ class RNMTPlusDecoderLayer(nn.Module):
         embeddeds = self.attn_combine(embeddeds)
 
         if self.rnn_type == "GRU":
+            # The cell is unused, so pass it through as is
             self.gru.flatten_parameters()
             rnn_output, hidden = self.gru(embeddeds, hidden.unsqueeze(0))
         else:
             self.lstm.flatten_parameters()
             rnn_output, (hidden, cell) = self.lstm(embeddeds, (hidden.unsqueeze(0), cell.unsqueeze(0)))
+            cell = cell.squeeze(0)
 
         output = self.layer_norm(rnn_output)
         output = self.dropout(output)
         output = output + inputs
-        return output, hidden.squeeze(0), cell.squeeze(0)
+        return output, hidden.squeeze(0), cell
 
     def init_rnn(self):
         if self.rnn_type =="GRU":
@@ -13,6 +13,7 @@ import collections, gc, torch
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.parallel._functions import Scatter
 from sacremoses import MosesDetokenizer
 # from torch.optim.lr_scheduler import _LRScheduler
 
@@ -67,6 +68,87 @@ class Parallel(nn.Sequential):
         return outputs
 
 
+class ChunkedDataParallel(nn.DataParallel):
+    '''
+    A torch.nn.DataParallel which, when passed chunk_sizes, scatters the batch dimension of the
+    inputs in those sizes rather than evenly, so each replica gets its own sub-batch. Inputs with a
+    scatter method, such as model.rnmt_plus.AttentionState, scatter themselves given the sizes.
+
+    The positional inputs at the indices in host_args and the keyword inputs named in host_kwargs,
+    such as the lengths pack_padded_sequence needs on the CPU, are split without leaving the CPU.
+    '''
+    def __init__(self, module, host_args=(), host_kwargs=(), **kwargs):
+        super(ChunkedDataParallel, self).__init__(module, **kwargs)
+
+        self.host_args = host_args
+        self.host_kwargs = host_kwargs
+
+    def forward(self, *inputs, chunk_sizes=None, **kwargs): # pylint:disable=arguments-differ
+        self.chunk_sizes = chunk_sizes
+        return super(ChunkedDataParallel, self).forward(*inputs, **kwargs)
+
+    def even_chunk_sizes(self, inputs, num_chunks):
+        ''' Get the sizes nn.DataParallel splits the batch of the first input tensor into '''
+        def batch_size(obj):
+            if isinstance(obj, torch.Tensor):
+                return obj.size(self.dim)
+            if isinstance(obj, (tuple, list)):
+                return next((size for size in map(batch_size, obj) if size is not None), None)
+            return None
+
+        size = batch_size(inputs)
+        if not size:
+            return None
+
+        chunk_size = -(-size // num_chunks)
+        return [min(chunk_size, size - start) for start in range(0, size, chunk_size)]
+
+    def scatter(self, inputs, kwargs, device_ids):
+        chunk_sizes = self.chunk_sizes
+        if not chunk_sizes or len(chunk_sizes) > len(device_ids):
+            chunk_sizes = self.even_chunk_sizes(inputs, len(device_ids))
+            if not chunk_sizes:
+                return super(ChunkedDataParallel, self).scatter(inputs, kwargs, device_ids)
+
+        device_ids = device_ids[:len(chunk_sizes)]
+        chunk_sizes = list(chunk_sizes)
+
+        def scatter_map(obj):
+            if isinstance(obj, torch.Tensor):
+                return Scatter.apply(device_ids, chunk_sizes, self.dim, obj)
+            if hasattr(obj, 'scatter'):
+                return obj.scatter(scatter_map, chunk_sizes)
+            if isinstance(obj, tuple) and obj:
+                return list(zip(*map(scatter_map, obj)))
+            if isinstance(obj, list) and obj:
+                return list(map(list, zip(*map(scatter_map, obj))))
+            if isinstance(obj, dict) and obj:
+                return list(map(type(obj), zip(*map(scatter_map, obj.items()))))
+            return [obj for _ in device_ids]
+
+        def split_host(obj):
+            if isinstance(obj, torch.Tensor) and not obj.is_cuda:
+                return list(obj.split(chunk_sizes, self.dim))
+            return scatter_map(obj)
+
+        try:
+            scattered_inputs = [
+                split_host(obj) if index in self.host_args else scatter_map(obj)
+                for index, obj in enumerate(inputs)
+            ]
+            scattered_kwargs = [
+                [(key, value) for value in (split_host(obj) if key in self.host_kwargs else scatter_map(obj))]
+                for key, obj in kwargs.items()
+            ]
+            return (
+                list(zip(*scattered_inputs)) if inputs else [() for _ in device_ids],
+                list(map(dict, zip(*scattered_kwargs))) if kwargs else [{} for _ in device_ids]
+            )
+        finally:
+            scatter_map = None
+            split_host = None
+
+
 def as_minutes(s):
     m = math.floor(s / 60)
     s -= m * 60
@@ -131,18 +213,59 @@ def debug_memory():
     print("--------")
 
 
+def format_prediction(pred, md, detokenize):
+    ''' Format a prediction as a line of text, cut off at the first <EOS> '''
+    if '<EOS>' in pred:
+        pred = pred[:pred.index('<EOS>')]
+    if detokenize:
+        return md.detokenize(' '.join(pred).replace('@@ ', '').split())
+    return ' '.join(pred)
+
+
 def save_predictions(preds, evaluate_path, detokenize):
     md = MosesDetokenizer()
     with open(evaluate_path, 'w') as f:
         for pred in preds:
-            if '<EOS>' in pred:
-                pred = pred[:pred.index('<EOS>')]
-            if detokenize:
-                # print("pred", pred)
-                output = md.detokenize(' '.join(pred).replace('@@ ', '').split())
-            else:
-                output = ' '.join(pred)
-            f.write(output + '\n')
+            f.write(format_prediction(pred, md, detokenize) + '\n')
+
+
+class PredictionWriter(object):
+    '''
+    Writes the predictions of a split to a file in example order, as soon as they are complete. The
+    predictions may arrive in any order, each is only held back until all the earlier examples have
+    been written.
+    '''
+    def __init__(self, evaluate_path, detokenize):
+        ''' Initialize the writer '''
+        self.evaluate_path = evaluate_path
+        self.detokenize = detokenize
+        self.md = MosesDetokenizer()
+
+        self.file = None
+        self.next_id = 0
+        self.pending = {}
+
+    def __enter__(self):
+        ''' Open the file '''
+        self.file = open(self.evaluate_path, 'w')
+        return self
+
+    def __exit__(self, *args):
+        ''' Close the file '''
+        if self.pending:
+            print("{} predictions were never written, missing example {}".format(len(self.pending), self.next_id))
+        self.file.close()
+
+    def write(self, example_id, pred):
+        ''' Add the prediction of an example, writing out any predictions which are now in order '''
+        self.pending[example_id] = pred
+        if self.next_id not in self.pending:
+            return
+
+        while self.next_id in self.pending:
+            self.file.write(format_prediction(self.pending.pop(self.next_id), self.md, self.detokenize) + '\n')
+            self.next_id += 1
+        self.file.flush()
 
 # Beam search utils
 
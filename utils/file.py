@@ -5,6 +5,7 @@ import io
 import os
 import glob
 import gzip
+import hashlib
 import math
 import tarfile
 import zipfile
@@ -60,6 +61,27 @@ def join(paths, output_path, batch_size=100):
         os.rename(incomplete_output_path, output_path)
 
 
+def fingerprint(path, block_size=1 << 20):
+    '''
+    Get a cheap fingerprint of a file: its size, modification time and a hash of its first and last
+    blocks. Hashing the full file would cost as much as reading it.
+    '''
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        digest.update(file.read(block_size))
+        if stat.st_size > block_size:
+            file.seek(max(block_size, stat.st_size - block_size))
+            digest.update(file.read(block_size))
+
+    return {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hash': digest.hexdigest()
+    }
+
+
 class Open(object):
     '''
     A class that acts like function/context manager similar to the builtin open, but supports
@@ -0,0 +1,133 @@
+'''
+Utilities for placing the processes of a run on the CPUs of a NUMA node.
+'''
+import functools
+import glob
+import os
+import re
+
+import torch
+
+
+def parse_cpulist(cpulist):
+    ''' Parse a cpulist such as "0-3,8-11" into a set of CPUs '''
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+
+    return cpus
+
+
+def numa_nodes():
+    ''' Get the sorted CPUs of each NUMA node which this process is allowed to run on '''
+    allowed = os.sched_getaffinity(0)
+
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for path in sorted(paths, key=lambda p: int(re.search(r'node(\d+)', p).group(1))):
+        with open(path, 'r') as cpulist:
+            cpus = parse_cpulist(cpulist.read()) & allowed
+        if cpus:
+            nodes.append(sorted(cpus))
+
+    # Without NUMA information, treat the machine as a single node
+    return nodes or [sorted(allowed)]
+
+
+def set_threads(intra_op, inter_op):
+    ''' Set the number of intra-op and inter-op threads torch uses in this process '''
+    torch.set_num_threads(intra_op)
+    try:
+        torch.set_num_interop_threads(inter_op)
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work, e.g. not after forking a worker
+        pass
+
+
+class Placement(object):
+    '''
+    Assigns each role of a run a set of CPUs on a single NUMA node, so processes neither float
+    across sockets nor oversubscribe the cores of each other. Each data worker (loading the training
+    data) and decode worker (loading the data being evaluated) gets a CPU of its own from the end of
+    the node, and runs single threaded. The main process, which runs the model, gets the rest of the
+    node and an intra-op thread per CPU. When there are not enough CPUs, the decode workers share
+    the CPUs of the data workers, then the workers share the CPUs of the main process.
+    '''
+    ROLES = ('main', 'data', 'decode')
+
+    def __init__(self, num_workers, node=None, inter_op_threads=1):
+        ''' Initialize the placement '''
+        self.nodes = numa_nodes()
+        self.node = node % len(self.nodes) if node is not None else 0
+        self.inter_op_threads = inter_op_threads
+
+        cpus = self.nodes[self.node]
+        num_workers = min(num_workers, len(cpus))
+        data_cpus = cpus[len(cpus) - num_workers:]
+
+        decode_cpus = cpus[len(cpus) - 2 * num_workers:len(cpus) - num_workers]
+        if len(decode_cpus) < num_workers:
+            decode_cpus = data_cpus
+
+        main_cpus = [cpu for cpu in cpus if cpu not in data_cpus and cpu not in decode_cpus]
+        self.cpus = {
+            'main': main_cpus or cpus,
+            'data': data_cpus or cpus,
+            'decode': decode_cpus or cpus
+        }
+
+    def worker_cpus(self, role, worker_id):
+        ''' Get the CPU set of the given worker of a role '''
+        cpus = self.cpus[role]
+        return {cpus[-1 - worker_id % len(cpus)]}
+
+    def threads(self, role):
+        ''' Get the (intra-op, inter-op) threads of a role '''
+        if role == 'main':
+            return len(self.cpus['main']), self.inter_op_threads
+
+        return 1, 1
+
+    def apply(self, role='main', worker_id=None):
+        ''' Place the current process, either the main process or the given worker of a role '''
+        if worker_id is None:
+            os.sched_setaffinity(0, self.cpus[role])
+        else:
+            os.sched_setaffinity(0, self.worker_cpus(role, worker_id))
+
+        set_threads(*self.threads(role))
+
+    def report(self):
+        ''' Get a description of the layout '''
+        lines = [f'Placement on NUMA node {self.node} of {len(self.nodes)}:']
+        for role in type(self).ROLES:
+            intra_op, inter_op = self.threads(role)
+            lines.append(
+                f'  {role}: cpus {",".join(str(cpu) for cpu in self.cpus[role])}, '
+                f'{intra_op} intra-op and {inter_op} inter-op threads'
+                + ('' if role == 'main' else ' per worker')
+            )
+
+        return '\n'.join(lines)
+
+
+@functools.lru_cache(maxsize=None)
+def make_placement(num_workers, node, inter_op_threads):
+    '''
+    Make a placement once per process, as once the main process has been placed, it is only allowed
+    to run on its own CPUs
+    '''
+    return Placement(num_workers, node, inter_op_threads)
+
+
+def get_placement(config):
+    ''' Get the placement of the run, if enabled. Each process of a run defaults to its own node. '''
+    if not config['placement']:
+        return None
+
+    node = config['placement_node'] if config['placement_node'] is not None else config['rank']
+    return make_placement(config['num_workers'], node, config['inter_op_threads'])